@@ -0,0 +1,99 @@
+"""Benchmark de compressão das respostas: bytes trafegados x CPU.
+
+Gera payloads sintéticos no formato de /stock/items e /stock/history em
+vários tamanhos e mede, para gzip e brotli em alguns níveis, o tamanho
+final, a razão de compressão e o tempo de CPU gasto. Também mede o modo
+streaming (NDJSON em lotes, com flush a cada lote), que é o usado pelas
+exportações.
+
+Uso (a partir da raiz do repositório):
+
+    python -m backend.benchmarks.bench_compression
+"""
+import os
+import random
+import time
+from datetime import date, timedelta
+
+os.environ.setdefault("SCHEDULER_ENABLED", "0")
+
+from backend.main import NDJSON_BATCH_ROWS, dumps_json, make_compressor, optional_module
+
+SIZES = (100, 1_000, 10_000, 100_000)
+LEVELS = {"gzip": (1, 6, 9), "br": (1, 4, 11)}
+REPEAT = 3
+
+
+def stock_items(rows):
+    rng = random.Random(rows)
+    return [
+        {
+            "productId": i,
+            "productName": f"Produto {rng.choice(['Arroz', 'Feijão', 'Café', 'Leite', 'Açúcar'])} {i}",
+            "quantity": rng.randint(0, 500),
+            "value": round(rng.uniform(0, 5000), 2),
+            "unitPrice": round(rng.uniform(1, 50), 2),
+        }
+        for i in range(rows)
+    ]
+
+
+def stock_history(rows):
+    rng = random.Random(rows)
+    start = date(2015, 1, 1)
+    stock = 1000
+    history = []
+    for i in range(rows):
+        entries = rng.choice((0, 0, 0, 50))
+        outputs = rng.randint(0, 20)
+        stock = max(0, stock + entries - outputs)
+        history.append({
+            "date": (start + timedelta(days=i)).isoformat(),
+            "quantity": stock,
+            "entries": entries,
+            "outputs": outputs,
+            "value": stock * 4.5,
+        })
+    return history
+
+
+def measure(chunks, encoding, level):
+    best = None
+    size = 0
+    for _ in range(REPEAT):
+        started = time.process_time()
+        compressor = make_compressor(encoding, level)
+        size = 0
+        for chunk in chunks[:-1]:
+            size += len(compressor.compress(chunk))
+        size += len(compressor.finish(chunks[-1]))
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return size, best
+
+
+def main():
+    encodings = ["gzip"] + (["br"] if optional_module("brotli") is not None else [])
+    if "br" not in encodings:
+        print("brotli não instalado: medindo apenas gzip\n")
+
+    print(f"{'payload':<14}{'linhas':>9}{'modo':>9}{'codif.':>8}{'nível':>7}{'bytes':>12}{'razão':>8}{'CPU ms':>9}")
+    for name, build in (("stock_items", stock_items), ("stock_history", stock_history)):
+        for rows in SIZES:
+            records = build(rows)
+            whole = [dumps_json(records)]
+            streamed = [
+                b"".join(dumps_json(r) + b"\n" for r in records[i:i + NDJSON_BATCH_ROWS])
+                for i in range(0, len(records), NDJSON_BATCH_ROWS)
+            ]
+            for mode, chunks in (("inteiro", whole), ("stream", streamed)):
+                raw = sum(len(c) for c in chunks)
+                print(f"{name:<14}{rows:>9}{mode:>9}{'-':>8}{'-':>7}{raw:>12}{1:>8.1f}{0:>9.1f}")
+                for encoding in encodings:
+                    for level in LEVELS[encoding]:
+                        size, cpu = measure(chunks, encoding, level)
+                        print(f"{name:<14}{rows:>9}{mode:>9}{encoding:>8}{level:>7}{size:>12}{raw / size:>8.1f}{cpu * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark de inicialização do processo da API.
+
+Mede, em processos novos, o tempo para importar backend.main, o tempo do
+ciclo de vida (startup + shutdown do lifespan) e a memória residente (pico
+de RSS) do worker, além dos módulos mais caros segundo -X importtime.
+Também confere que o SDK da OpenAI não é carregado no boot.
+
+Uso (a partir da raiz do repositório):
+
+    python -m backend.benchmarks.bench_startup [repetições]
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROBE = r"""
+import asyncio, json, resource, sys, time
+started = time.perf_counter()
+import backend.main as main
+imported = time.perf_counter()
+
+async def cycle():
+    async with main.lifespan(main.app):
+        pass
+
+asyncio.run(cycle())
+finished = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "lifespan_ms": (finished - imported) * 1000,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "openai_loaded": "openai" in sys.modules,
+    "modules": len(sys.modules),
+}))
+"""
+
+
+def run_probe(env):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def top_imports(env, limit=10):
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import backend.main"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stderr
+    # Agrupa pelo pacote raiz; a importação mais externa de cada pacote é a
+    # que tem o maior tempo cumulativo
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            cumulative = int(cumulative)
+        except ValueError:
+            continue
+        package = name.strip().split(".")[0]
+        if package != "backend":
+            packages[package] = max(packages.get(package, 0), cumulative)
+    return sorted(((us, name) for name, us in packages.items()), reverse=True)[:limit]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    env = {**os.environ, "SCHEDULER_ENABLED": "0", "PYTHONDONTWRITEBYTECODE": "1"}
+
+    runs = [run_probe(env) for _ in range(repeat)]
+    print(f"{'execução':>9}{'import ms':>12}{'lifespan ms':>13}{'RSS MB':>9}{'módulos':>9}{'openai':>8}")
+    for i, run in enumerate(runs, 1):
+        print(
+            f"{i:>9}{run['import_ms']:>12.1f}{run['lifespan_ms']:>13.1f}"
+            f"{run['max_rss_mb']:>9.1f}{run['modules']:>9}{'sim' if run['openai_loaded'] else 'não':>8}"
+        )
+    imports = sorted(run["import_ms"] for run in runs)
+    print(f"\nmediana do import: {imports[len(imports) // 2]:.1f} ms")
+
+    print("\nmódulos de topo mais caros (tempo cumulativo):")
+    for cumulative, name in top_imports(env):
+        print(f"  {cumulative / 1000:>8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Benchmark de escalabilidade do modo multi-processo (1 a N workers).
+
+Para cada quantidade de workers sobe `python -m backend.main` com
+WEB_CONCURRENCY=N, espera a API responder e dispara requisições a partir de
+vários processos clientes (conexões keep-alive) durante alguns segundos,
+medindo requisições por segundo, latência p50/p99 e o ganho sobre 1 worker.
+
+O caminho padrão é "/", que não depende do banco e mede o teto de CPU do
+servidor; com um banco configurado, use por exemplo --path /products para
+medir o índice de produtos pré-carregado.
+
+Uso (a partir da raiz do repositório):
+
+    python -m backend.benchmarks.bench_workers [--path /] [--duration 5] [--workers 1,2,4]
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HOST = "127.0.0.1"
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(HOST, port, timeout=1)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            conn.close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def client(port, path, duration, results):
+    conn = http.client.HTTPConnection(HOST, port, timeout=10)
+    latencies = []
+    errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection(HOST, port, timeout=10)
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+    results.put((latencies, errors))
+
+
+def run(workers, port, path, duration, clients):
+    env = {
+        **os.environ,
+        "WEB_CONCURRENCY": str(workers),
+        "API_HOST": HOST,
+        "API_PORT": str(port),
+        "SCHEDULER_ENABLED": "0",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "backend.main"], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        if not wait_ready(port):
+            raise RuntimeError(f"API não respondeu com {workers} workers")
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=client, args=(port, path, duration, results))
+            for _ in range(clients)
+        ]
+        for process in processes:
+            process.start()
+        latencies, errors = [], 0
+        for _ in processes:
+            partial, partial_errors = results.get()
+            latencies.extend(partial)
+            errors += partial_errors
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "rps": count / duration,
+        "p50": latencies[count // 2] * 1000 if count else 0,
+        "p99": latencies[int(count * 0.99)] * 1000 if count else 0,
+        "errors": errors,
+    }
+
+
+def main():
+    cores = os.cpu_count() or 1
+    default_workers = sorted({1, 2, 4, cores} & set(range(1, cores + 1)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default="/")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--workers", default=",".join(map(str, default_workers)))
+    parser.add_argument("--clients", type=int, default=max(4, cores * 2))
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"caminho {args.path}, {args.clients} clientes, {args.duration:.0f}s por rodada, {cores} núcleos")
+    print(f"{'workers':>8}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'erros':>7}{'ganho':>8}")
+    baseline = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        result = run(workers, args.port, args.path, args.duration, args.clients)
+        baseline = baseline or result["rps"]
+        print(
+            f"{workers:>8}{result['rps']:>10.0f}{result['p50']:>9.2f}{result['p99']:>9.2f}"
+            f"{result['errors']:>7}{result['rps'] / baseline:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,27 +2,51 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
-from datetime import date
+from datetime import date, timedelta
+from decimal import Decimal
+from collections import OrderedDict
+import json
+import math
+import random
+import threading
+import time
+import zlib
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import cursor as TupleCursor
+from psycopg2.extras import Json, RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import os
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request
-from openai import OpenAI
+from fastapi import APIRouter, FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import importlib
 from pydantic import BaseModel
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-app = FastAPI(title="Sales Synergy API")
+# As rotas ficam no router e o app é montado por create_app(); dependências
+# pesadas (SDK da OpenAI, pyarrow, msgpack, brotli, orjson) só são importadas
+# no primeiro uso, para que os workers subam rápido.
+router = APIRouter()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+
+@lru_cache(maxsize=None)
+def get_llm_client():
+    from openai import OpenAI
+
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+@lru_cache(maxsize=None)
+def optional_module(name):
+    """Importa uma dependência opcional uma única vez; None se não estiver instalada."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
 
 DB_CONFIG = {
     "user": os.getenv("DB_USER"),
@@ -33,19 +57,174 @@ DB_CONFIG = {
 }
 
 
-def get_db_connection():
+# Roteamento das conexões por classe de rota. Cada classe tem seu próprio pool
+# e statement_timeout, de modo que as consultas analíticas pesadas não esgotem
+# as conexões das buscas de produto; as classes marcadas com replicas=True vão
+# para as réplicas de leitura (DB_REPLICA_DSNS) e voltam para o primário
+# quando nenhuma réplica está saudável.
+DB_REPLICA_DSNS = [dsn.strip() for dsn in os.getenv("DB_REPLICA_DSNS", "").split(",") if dsn.strip()]
+DB_REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", "30"))
+DB_POOL_WAIT_SECONDS = float(os.getenv("DB_POOL_WAIT_SECONDS", "10"))
+
+ROUTE_CLASSES = {
+    # Escritas, cache de agregados e rotas transacionais
+    "default": {"replicas": False, "pool_size": 5, "statement_timeout_ms": 30000},
+    # /products e /products/search: consultas curtas por chave
+    "lookup": {"replicas": False, "pool_size": 10, "statement_timeout_ms": 5000},
+    # Análises, estoque, mark-up e contexto do /analytics
+    "analytics": {"replicas": True, "pool_size": 5, "statement_timeout_ms": 120000},
+    # Só o agendador: advisory lock dos jobs e as reconstruções pesadas
+    # (linha de base de encarte, resumo de clientes), que rodam nessa conexão
+    "jobs": {"replicas": False, "pool_size": 1, "statement_timeout_ms": 1800000},
+}
+
+for _name, _route in ROUTE_CLASSES.items():
+    _route["pool_size"] = int(os.getenv(f"DB_POOL_{_name.upper()}_SIZE", _route["pool_size"]))
+    _route["statement_timeout_ms"] = int(os.getenv(f"DB_STATEMENT_TIMEOUT_{_name.upper()}_MS", _route["statement_timeout_ms"]))
+
+
+class PooledConnection:
+    """Conexão emprestada de um pool; close() devolve a conexão ao pool."""
+
+    def __init__(self, conn, pool, release):
+        self._conn = conn
+        self._pool = pool
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                # Encerra a transação aberta implicitamente pelas leituras
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        try:
+            self._pool.putconn(conn, close=broken)
+        finally:
+            self._release()
+
+    # Garante a devolução ao pool mesmo quando a rota esquece de fechar
+    __del__ = close
+
+
+class DatabaseRouter:
+    def __init__(self, routes, replica_dsns):
+        self.routes = routes
+        self.replica_dsns = replica_dsns
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._slots = {name: threading.BoundedSemaphore(route["pool_size"]) for name, route in routes.items()}
+        self._unhealthy_until = {}
+        self._next_replica = 0
+
+    def _targets(self, route):
+        if not route["replicas"] or not self.replica_dsns:
+            return ["primary"]
+        now = time.time()
+        with self._lock:
+            start = self._next_replica
+            self._next_replica = (self._next_replica + 1) % len(self.replica_dsns)
+        order = [(start + i) % len(self.replica_dsns) for i in range(len(self.replica_dsns))]
+        healthy = [i for i in order if self._unhealthy_until.get(i, 0) <= now]
+        return healthy + ["primary"]
+
+    def _pool(self, route_name, target):
+        key = (route_name, target)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                route = self.routes[route_name]
+                options = f"-c statement_timeout={route['statement_timeout_ms']}"
+                if target == "primary":
+                    pool = ThreadedConnectionPool(
+                        0, route["pool_size"],
+                        user=DB_CONFIG["user"],
+                        password=DB_CONFIG["password"],
+                        host=DB_CONFIG["host"],
+                        port=DB_CONFIG["port"],
+                        database=DB_CONFIG["database"],
+                        sslmode='require',
+                        cursor_factory=RealDictCursor,
+                        options=options
+                    )
+                else:
+                    pool = ThreadedConnectionPool(
+                        0, route["pool_size"], self.replica_dsns[target],
+                        cursor_factory=RealDictCursor,
+                        options=options
+                    )
+                self._pools[key] = pool
+            return pool
+
+    def connect(self, route_name):
+        route = self.routes[route_name]
+        slots = self._slots[route_name]
+        if not slots.acquire(timeout=DB_POOL_WAIT_SECONDS):
+            raise HTTPException(status_code=503, detail=f"Sem conexões disponíveis para {route_name}, tente novamente")
+        try:
+            targets = self._targets(route)
+            for target in targets:
+                try:
+                    pool = self._pool(route_name, target)
+                    conn = pool.getconn()
+                    if conn.closed:
+                        pool.putconn(conn, close=True)
+                        conn = pool.getconn()
+                    return PooledConnection(conn, pool, slots.release)
+                except psycopg2.OperationalError as e:
+                    if target == "primary":
+                        raise
+                    print(f"Réplica {target} indisponível, tentando a próxima: {e}")
+                    self._unhealthy_until[target] = time.time() + DB_REPLICA_RETRY_SECONDS
+        except BaseException:
+            slots.release()
+            raise
+
+    def resize(self, pool_sizes):
+        """Ajusta o tamanho dos pools; deve ser chamado antes de abrir conexões."""
+        for name, size in pool_sizes.items():
+            self.routes[name]["pool_size"] = size
+            self._slots[name] = threading.BoundedSemaphore(size)
+
+    def status(self):
+        now = time.time()
+        return {
+            "routes": {
+                name: {
+                    "poolSize": route["pool_size"],
+                    "statementTimeoutMs": route["statement_timeout_ms"],
+                    "usesReplicas": route["replicas"] and bool(self.replica_dsns),
+                }
+                for name, route in self.routes.items()
+            },
+            "replicas": [
+                {"index": i, "healthy": self._unhealthy_until.get(i, 0) <= now}
+                for i in range(len(self.replica_dsns))
+            ],
+        }
+
+    def close_all(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.closeall()
+
+
+db_router = DatabaseRouter(ROUTE_CLASSES, DB_REPLICA_DSNS)
+
+
+def get_db_connection(route="default"):
     try:
-        conn = psycopg2.connect(
-            user=DB_CONFIG["user"],
-            password=DB_CONFIG["password"],
-            host=DB_CONFIG["host"],
-            port=DB_CONFIG["port"],
-            database=DB_CONFIG["database"],
-            sslmode='require',
-            cursor_factory=RealDictCursor
-        )
-        print("Conexão com o banco estabelecida com sucesso!")
-        return conn
+        return db_router.connect(route)
+    except HTTPException:
+        raise
     except psycopg2.OperationalError as e:
         print(f"Erro operacional ao conectar ao banco: {e}")
         raise HTTPException(status_code=500, detail=f"Erro de conexão com o banco: {e}")
@@ -53,6 +232,349 @@ def get_db_connection():
         print(f"Erro ao conectar ao banco de dados: {e}")
         raise HTTPException(status_code=500, detail="Erro de conexão com o banco de dados")
 
+
+# Coalescência de requisições (single-flight): quando vários clientes pedem a
+# mesma consulta pesada ao mesmo tempo, apenas um executa e os demais aguardam
+# o resultado em andamento em vez de disparar a mesma consulta no Postgres.
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "30"))
+
+# Timeout (em segundos) de espera por chave; chaves ausentes usam o padrão
+SINGLE_FLIGHT_TIMEOUTS = {
+    "stock_total": float(os.getenv("SINGLE_FLIGHT_TIMEOUT_STOCK_TOTAL", SINGLE_FLIGHT_TIMEOUT)),
+    "stock_items": float(os.getenv("SINGLE_FLIGHT_TIMEOUT_STOCK_ITEMS", SINGLE_FLIGHT_TIMEOUT)),
+    "markup_general": float(os.getenv("SINGLE_FLIGHT_TIMEOUT_MARKUP", SINGLE_FLIGHT_TIMEOUT)),
+    "analysis_sales": float(os.getenv("SINGLE_FLIGHT_TIMEOUT_ANALYSIS", SINGLE_FLIGHT_TIMEOUT)),
+    "analytics_context": float(os.getenv("SINGLE_FLIGHT_TIMEOUT_ANALYTICS", SINGLE_FLIGHT_TIMEOUT)),
+}
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Executa uma única vez chamadas concorrentes com a mesma chave."""
+
+    def __init__(self, timeouts, default_timeout):
+        self.timeouts = timeouts
+        self.default_timeout = default_timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._metrics = {}
+
+    def _count(self, name, field):
+        metrics = self._metrics.setdefault(
+            name, {"leaders": 0, "coalesced": 0, "timeouts": 0, "errors": 0}
+        )
+        metrics[field] += 1
+
+    def do(self, key, fn):
+        name = key[0]
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _InFlightCall()
+                self._calls[key] = call
+            self._count(name, "leaders" if is_leader else "coalesced")
+
+        if is_leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+                with self._lock:
+                    self._count(name, "errors")
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+        elif not call.event.wait(self.timeouts.get(name, self.default_timeout)):
+            with self._lock:
+                self._count(name, "timeouts")
+            raise HTTPException(status_code=504, detail="Tempo esgotado aguardando consulta em andamento")
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def metrics(self):
+        with self._lock:
+            in_flight = {}
+            for key in self._calls:
+                in_flight[key[0]] = in_flight.get(key[0], 0) + 1
+            return {
+                name: {
+                    **values,
+                    "inFlight": in_flight.get(name, 0),
+                    "timeout": self.timeouts.get(name, self.default_timeout),
+                }
+                for name, values in self._metrics.items()
+            }
+
+
+def flight_key(name, **params):
+    """Monta a chave de coalescência a partir do endpoint e dos parâmetros normalizados."""
+    normalized = []
+    for param, value in sorted(params.items()):
+        if isinstance(value, str):
+            value = value.strip().lower()
+        normalized.append((param, value))
+    return (name, tuple(normalized))
+
+
+single_flight = SingleFlight(SINGLE_FLIGHT_TIMEOUTS, SINGLE_FLIGHT_TIMEOUT)
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Tipo não serializável: {type(value).__name__}")
+
+
+# Cache de resultados pré-calculados pelo agendador. Os valores ficam na tabela
+# cache_agregados (compartilhada entre workers) e numa cópia local de vida curta
+# para que as requisições virem uma simples leitura. A cópia local é um LRU
+# limitado; as chaves parametrizadas (período, limites) gravadas sob demanda
+# são apagadas da tabela pelo job result_cache_purge depois de
+# RESULT_CACHE_PURGE_AGE segundos, que deve passar do maior max_age usado.
+RESULT_CACHE_LOCAL_TTL = float(os.getenv("RESULT_CACHE_LOCAL_TTL", "5"))
+RESULT_CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_LOCAL_MAX_ENTRIES", "1024"))
+RESULT_CACHE_PURGE_AGE = float(os.getenv("RESULT_CACHE_PURGE_AGE", "172800"))
+
+RESULT_CACHE_DDL = """
+    CREATE TABLE IF NOT EXISTS cache_agregados (
+        chave TEXT PRIMARY KEY,
+        valor JSONB NOT NULL,
+        atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+        duracao_ms INTEGER
+    )
+"""
+
+
+class ResultCache:
+    """Leitura e escrita dos agregados pré-calculados."""
+
+    def __init__(self, local_ttl, local_max_entries):
+        self.local_ttl = local_ttl
+        self.local_max_entries = local_max_entries
+        self._lock = threading.Lock()
+        self._local = OrderedDict()
+
+    def get(self, key, max_age):
+        now = time.time()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                self._local.move_to_end(key)
+        if entry is None or now - entry["lido_em"] > self.local_ttl:
+            entry = self._load(key, now)
+        if entry["valor"] is None or now - entry["atualizado_em"] > max_age:
+            return None
+        return entry["valor"]
+
+    def _load(self, key, now):
+        # Ausências e falhas também ficam guardadas localmente, para não
+        # consultar a tabela a cada requisição enquanto o job não rodou
+        entry = {"valor": None, "atualizado_em": 0.0, "lido_em": now}
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "SELECT valor, EXTRACT(EPOCH FROM atualizado_em) AS atualizado_em FROM cache_agregados WHERE chave = %s",
+                    (key,)
+                )
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+                conn.close()
+            if row:
+                entry["valor"] = row["valor"]
+                entry["atualizado_em"] = float(row["atualizado_em"])
+        except Exception as e:
+            print(f"Erro ao ler cache de agregados ({key}): {e}")
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._local[key] = entry
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_max_entries:
+                self._local.popitem(last=False)
+
+    def set(self, cursor, key, value, duration_ms):
+        cursor.execute(
+            """
+            INSERT INTO cache_agregados (chave, valor, atualizado_em, duracao_ms)
+            VALUES (%s, %s, now(), %s)
+            ON CONFLICT (chave) DO UPDATE
+            SET valor = EXCLUDED.valor, atualizado_em = EXCLUDED.atualizado_em, duracao_ms = EXCLUDED.duracao_ms
+            """,
+            (key, Json(value, dumps=lambda v: json.dumps(v, default=_json_default)), duration_ms)
+        )
+        now = time.time()
+        self._remember(key, {
+            "valor": json.loads(json.dumps(value, default=_json_default)),
+            "atualizado_em": now,
+            "lido_em": now,
+        })
+
+    def purge(self, cursor, keep, max_age):
+        """Apaga da tabela as chaves fora de keep sem atualização há max_age segundos."""
+        cursor.execute(
+            """
+            DELETE FROM cache_agregados
+            WHERE NOT (chave = ANY(%s)) AND atualizado_em < now() - make_interval(secs => %s)
+            """,
+            (list(keep), max_age)
+        )
+        return cursor.rowcount
+
+
+result_cache = ResultCache(RESULT_CACHE_LOCAL_TTL, RESULT_CACHE_LOCAL_MAX_ENTRIES)
+
+
+def store_result(key, value, duration_ms):
+    """Grava um resultado calculado sob demanda em cache_agregados (melhor esforço)."""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            result_cache.set(cursor, key, value, duration_ms)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+    except Exception as e:
+        print(f"Erro ao gravar cache de agregados ({key}): {e}")
+
+
+def cached_result(name, key, max_age, compute, valid=None):
+    """Como cached_aggregate, para chaves parametrizadas (ex.: um período).
+
+    valid, se informado, recebe o valor guardado e decide se ele ainda serve.
+    """
+    value = result_cache.get(key, max_age)
+    if value is not None and (valid is None or valid(value)):
+        return value
+
+    def compute_and_store():
+        started = time.time()
+        value = compute()
+        store_result(key, value, int((time.time() - started) * 1000))
+        return value
+
+    return single_flight.do((name, key), compute_and_store)
+
+
+def purge_result_cache(conn):
+    # Os agregados do agendador ficam; só as chaves parametrizadas expiram
+    cursor = conn.cursor()
+    try:
+        deleted = result_cache.purge(cursor, scheduler.jobs, RESULT_CACHE_PURGE_AGE)
+    finally:
+        cursor.close()
+    return {"deleted": deleted}
+
+
+def cached_aggregate(name, compute):
+    """Devolve o agregado pré-calculado ou calcula sob demanda (com coalescência)."""
+    value = result_cache.get(name, job_max_staleness(name))
+    if value is not None:
+        return value
+    return single_flight.do(flight_key(name), compute)
+
+# Dicionário de produtos e índice de busca por nome em memória. No modo com
+# vários workers ele é carregado no processo mestre antes do fork e fica
+# compartilhado (copy-on-write) entre os workers; depois de PRODUCT_INDEX_TTL
+# segundos cada processo recarrega sua cópia em segundo plano.
+#
+# Troca assumida: a partir da primeira recarga cada worker passa a ter a sua
+# própria cópia (N cópias em memória, sem o compartilhamento do boot), e
+# /products e nomes/preços em /products/search podem ficar até TTL segundos
+# atrasados. Produtos ausentes do índice são buscados no banco, então um
+# produto novo nunca dá 404 por causa do índice. Com PRODUCT_INDEX_TTL=0 os
+# workers não recarregam: a cópia do mestre continua compartilhada e só muda
+# ao reiniciar o serviço.
+PRODUCT_INDEX_TTL = float(os.getenv("PRODUCT_INDEX_TTL", "900"))
+
+
+class ProductIndex:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.rows = ()
+        self.by_id = {}
+        self.names = ()
+        self.loaded_at = None
+        self._refreshing = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    def load(self):
+        conn = get_db_connection("lookup")
+        cursor = conn.cursor(cursor_factory=TupleCursor)
+        try:
+            cursor.execute("SELECT id_produto, nome_produto, preco FROM produto ORDER BY id_produto")
+            rows = tuple(cursor.fetchall())
+        finally:
+            cursor.close()
+            conn.close()
+        # Troca as referências de uma vez; leitores veem o índice antigo ou o novo
+        self.rows = rows
+        self.by_id = {row[0]: row for row in rows}
+        self.names = tuple(row[1].casefold() for row in rows)
+        self.loaded_at = time.time()
+        return len(rows)
+
+    def try_load(self):
+        try:
+            count = self.load()
+            print(f"Índice de produtos carregado: {count} produtos")
+        except Exception as e:
+            print(f"Erro ao carregar índice de produtos: {e}")
+
+    def _refresh_if_stale(self):
+        if not self.loaded or self.ttl <= 0 or time.time() - self.loaded_at < self.ttl:
+            return
+        if self._refreshing.acquire(blocking=False):
+            def refresh():
+                try:
+                    self.try_load()
+                finally:
+                    self._refreshing.release()
+            threading.Thread(target=refresh, name="product-index", daemon=True).start()
+
+    def get(self, product_id):
+        self._refresh_if_stale()
+        return self.by_id.get(product_id)
+
+    def search(self, query):
+        """Primeiro produto cujo nome contém `query` (equivalente ao ILIKE '%query%')."""
+        self._refresh_if_stale()
+        needle = query.casefold()
+        for position, name in enumerate(self.names):
+            if needle in name:
+                return self.rows[position]
+        return None
+
+    def all(self):
+        self._refresh_if_stale()
+        return self.rows
+
+
+product_index = ProductIndex(PRODUCT_INDEX_TTL)
+
+PRODUCT_COLUMNS = ("id_produto", "nome_produto", "preco")
+
 class Product(BaseModel):
     id_produto: int
     nome_produto: str
@@ -60,8 +582,8 @@ class Product(BaseModel):
 
 class Purchase(BaseModel):
     id_compra: int
-    data_compra: str
-    cpf: str
+    data_compra: date
+    cpf: Optional[str] = None
 
 class PurchaseItem(BaseModel):
     id: int
@@ -80,6 +602,17 @@ class SalesDifference(BaseModel):
     absoluteValue: int
     isIncrease: bool
 
+class EstimateBounds(BaseModel):
+    lower: int
+    upper: int
+
+class Approximation(BaseModel):
+    method: str
+    samplePercent: float
+    confidence: float
+    startDateSales: EstimateBounds
+    endDateSales: EstimateBounds
+
 class SalesAnalysis(BaseModel):
     productId: int
     productName: str
@@ -88,8 +621,262 @@ class SalesAnalysis(BaseModel):
     salesDifference: SalesDifference
     relatedProducts: List[RelatedProductData]
     showComparison: bool
+    approximation: Optional[Approximation] = None
+
+
+# Codificação das respostas grandes. Linhas vindas do banco são confiáveis, então
+# são serializadas direto (sem passar de novo pela validação do response_model),
+# e o cliente pode pedir layouts mais compactos via ?format= ou Accept.
+RESPONSE_FORMATS = {
+    "json": "application/json",
+    "columnar": "application/vnd.sales-synergy.columnar+json",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "msgpack": "application/x-msgpack",
+    "ndjson": "application/x-ndjson",
+}
+
+NDJSON_BATCH_ROWS = 500
+
+ACCEPT_FORMATS = {
+    "application/vnd.sales-synergy.columnar+json": "columnar",
+    "application/vnd.apache.arrow.stream": "arrow",
+    "application/x-msgpack": "msgpack",
+    "application/msgpack": "msgpack",
+    "application/x-ndjson": "ndjson",
+}
+
+
+def negotiate_format(request):
+    requested = request.query_params.get("format")
+    if requested:
+        requested = requested.lower()
+        if requested not in RESPONSE_FORMATS:
+            raise HTTPException(status_code=406, detail=f"Formato não suportado: {requested}")
+        return requested
+    for media_type in request.headers.get("accept", "").split(","):
+        media_type = media_type.split(";")[0].strip().lower()
+        if media_type in ACCEPT_FORMATS:
+            return ACCEPT_FORMATS[media_type]
+    return "json"
+
+
+def _plain(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def dumps_json(payload):
+    orjson = optional_module("orjson")
+    if orjson is None:
+        return json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=_json_default).encode("utf-8")
+    return orjson.dumps(payload, default=_json_default)
+
+
+def _encode_arrow(columns, rows, meta):
+    pa = optional_module("pyarrow")
+    if pa is None:
+        raise HTTPException(status_code=406, detail="Formato arrow indisponível: instale pyarrow")
+    data = {
+        name: [float(row[i]) if isinstance(row[i], Decimal) else row[i] for row in rows]
+        for i, name in enumerate(columns)
+    }
+    table = pa.table(data)
+    if meta:
+        table = table.replace_schema_metadata({"meta": dumps_json(meta)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_table(request, columns, rows, key=None, meta=None):
+    """Serializa linhas (tuplas na ordem de `columns`) no formato negociado.
+
+    Sem `key` a resposta JSON é a própria lista de objetos; com `key` ela vai
+    dentro de `meta` sob essa chave (ex.: o histórico de /stock/history).
+    """
+    response_format = negotiate_format(request)
+    media_type = RESPONSE_FORMATS[response_format]
+
+    if response_format == "ndjson":
+        return StreamingResponse(_ndjson_lines(columns, rows, key, meta), media_type=media_type)
+
+    if response_format == "json":
+        records = [dict(zip(columns, row)) for row in rows]
+        payload = {**meta, key: records} if key else records
+        return Response(dumps_json(payload), media_type=media_type)
+
+    if response_format == "arrow":
+        return Response(_encode_arrow(columns, rows, {**(meta or {}), "key": key} if key else meta), media_type=media_type)
+
+    table = {
+        "columns": list(columns),
+        "rowCount": len(rows),
+        "data": {name: [row[i] for row in rows] for i, name in enumerate(columns)},
+    }
+    payload = {**meta, key: table} if key else table
+
+    if response_format == "msgpack":
+        msgpack = optional_module("msgpack")
+        if msgpack is None:
+            raise HTTPException(status_code=406, detail="Formato msgpack indisponível: instale msgpack")
+        return Response(msgpack.packb(payload, default=_plain), media_type=media_type)
+
+    return Response(dumps_json(payload), media_type=media_type)
+
+
+def _ndjson_lines(columns, rows, key, meta):
+    # Uma linha por registro, enviadas em lotes; com `key` a primeira linha traz os metadados
+    if key:
+        yield dumps_json(meta) + b"\n"
+    for start in range(0, len(rows), NDJSON_BATCH_ROWS):
+        batch = rows[start:start + NDJSON_BATCH_ROWS]
+        yield b"".join(dumps_json(dict(zip(columns, row))) + b"\n" for row in batch)
+
+
+def encode_records(request, records, columns, key=None, meta=None):
+    rows = [tuple(record[name] for name in columns) for record in records]
+    return encode_table(request, columns, rows, key=key, meta=meta)
+
+
+# Compressão das respostas (gzip ou brotli, conforme o Accept-Encoding).
+# Respostas em streaming são comprimidas pedaço a pedaço, com flush a cada
+# pedaço, sem acumular o corpo inteiro em memória.
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/vnd.", "application/x-msgpack", "text/")
+
+
+class _GzipCompressor:
+    encoding = "gzip"
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b""):
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class _BrotliCompressor:
+    encoding = "br"
+
+    def __init__(self, quality):
+        self._compressor = optional_module("brotli").Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data=b""):
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+def make_compressor(encoding, level=None):
+    if encoding == "br":
+        return _BrotliCompressor(COMPRESSION_BROTLI_QUALITY if level is None else level)
+    return _GzipCompressor(COMPRESSION_GZIP_LEVEL if level is None else level)
+
+
+def negotiate_encoding(accept_encoding):
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name] = quality
+    if accepted.get("br", 0) > 0 and optional_module("brotli") is not None:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            if passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if compressor is None:
+                response_headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in start_message["headers"]}
+                content_type = response_headers.get("content-type", "")
+                if (
+                    "content-encoding" in response_headers
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                    or (not more_body and len(body) < self.minimum_size)
+                ):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+
+                compressor = make_compressor(encoding)
+                raw_headers = [
+                    (k, v) for k, v in start_message["headers"] if k.lower() not in (b"content-length", b"vary")
+                ]
+                vary = response_headers.get("vary")
+                raw_headers.append((b"vary", f"{vary}, Accept-Encoding".encode("latin-1") if vary else b"Accept-Encoding"))
+                raw_headers.append((b"content-encoding", encoding.encode("latin-1")))
+                if not more_body:
+                    body = compressor.finish(body)
+                    raw_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+                    await send({**start_message, "headers": raw_headers})
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send({**start_message, "headers": raw_headers})
+
+            if more_body:
+                chunk = compressor.compress(body)
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            else:
+                await send({"type": "http.response.body", "body": compressor.finish(body)})
 
-@app.get("/test-db-connection")
+        await self.app(scope, receive, send_compressed)
+
+
+@router.get("/test-db-connection")
 async def test_db():
     try:
         conn = get_db_connection()
@@ -102,25 +889,48 @@ async def test_db():
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-@app.get("/")
+@router.get("/")
 def read_root():
     return {"message": "Bem-vindo à API do Sales Synergy Analyzer"}
 
-@app.get("/products", response_model=List[Product])
-def get_products():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@router.get("/metrics/single-flight")
+def get_single_flight_metrics():
+    return single_flight.metrics()
+
+@router.get("/db/routing")
+def get_db_routing():
+    return db_router.status()
+
+@router.get("/products", response_model=List[Product])
+def get_products(request: Request):
+    if product_index.loaded:
+        return encode_table(request, PRODUCT_COLUMNS, product_index.all())
+
+    conn = get_db_connection("lookup")
+    cursor = conn.cursor(cursor_factory=TupleCursor)
     try:
         cursor.execute("SELECT id_produto, nome_produto, preco FROM produto")
         products = cursor.fetchall()
-        return products
+        return encode_table(request, PRODUCT_COLUMNS, products)
     finally:
         cursor.close()
         conn.close()
 
-@app.get("/products/search/{query}", response_model=Product)
+@router.get("/products/search/{query}", response_model=Product)
 def search_product(query: str, search_type: str = "product"):
-    conn = get_db_connection()
+    if product_index.loaded:
+        if search_type == "product":
+            product = product_index.search(query)
+        else:
+            try:
+                product = product_index.get(int(query))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="ID do produto deve ser um número")
+        if product:
+            return dict(zip(PRODUCT_COLUMNS, product))
+        # Ausente do índice: pode ser um produto criado depois da carga
+
+    conn = get_db_connection("lookup")
     cursor = conn.cursor()
     try:
         if search_type == "product":
@@ -140,7 +950,7 @@ def search_product(query: str, search_type: str = "product"):
         cursor.close()
         conn.close()
 
-@app.get("/purchases/date-range", response_model=List[Purchase])
+@router.get("/purchases/date-range", response_model=List[Purchase])
 def get_purchases_by_date_range(start_date: str, end_date: str):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -155,24 +965,24 @@ def get_purchases_by_date_range(start_date: str, end_date: str):
         cursor.close()
         conn.close()
 
-@app.get("/purchase-items/by-purchase-ids", response_model=List[PurchaseItem])
-def get_purchase_items_by_purchase_ids(purchase_ids: str):
+@router.get("/purchase-items/by-purchase-ids", response_model=List[PurchaseItem])
+def get_purchase_items_by_purchase_ids(request: Request, purchase_ids: str):
     ids = [int(id) for id in purchase_ids.split(",")]
     
     conn = get_db_connection()
-    cursor = conn.cursor()
+    cursor = conn.cursor(cursor_factory=TupleCursor)
     try:
         cursor.execute(
             "SELECT id, id_compra, id_produto, valor_unitario, encarte FROM itens_compra WHERE id_compra = ANY(%s)",
             (ids,)
         )
         items = cursor.fetchall()
-        return items
+        return encode_table(request, ("id", "id_compra", "id_produto", "valor_unitario", "encarte"), items)
     finally:
         cursor.close()
         conn.close()
 
-@app.get("/analysis/sales", response_model=SalesAnalysis)
+@router.get("/analysis/sales", response_model=SalesAnalysis, response_model_exclude_none=True)
 def analyze_sales(
     product_id: int,
     start_date: str,
@@ -182,9 +992,49 @@ def analyze_sales(
     first_product_id: Optional[int] = None,
     compare_periods: bool = False,
     second_start_date: Optional[str] = None,
-    second_end_date: Optional[str] = None
+    second_end_date: Optional[str] = None,
+    approx: bool = False
 ):
-    conn = get_db_connection()
+    if approx:
+        key = flight_key(
+            "analysis_sales_approx",
+            product_id=product_id,
+            start_date=start_date,
+            end_date=end_date,
+            comparison_type=comparison_type,
+            is_second_product=is_second_product,
+            first_product_id=first_product_id,
+            compare_periods=compare_periods,
+            second_start_date=second_start_date,
+            second_end_date=second_end_date,
+        )
+        return single_flight.do(key, lambda: _analyze_sales_approx(
+            product_id, start_date, end_date, comparison_type, is_second_product,
+            first_product_id, compare_periods, second_start_date, second_end_date
+        ))
+
+    key = flight_key(
+        "analysis_sales",
+        product_id=product_id,
+        start_date=start_date,
+        end_date=end_date,
+        comparison_type=comparison_type,
+        is_second_product=is_second_product,
+        first_product_id=first_product_id,
+        compare_periods=compare_periods,
+        second_start_date=second_start_date,
+        second_end_date=second_end_date,
+    )
+    return single_flight.do(key, lambda: _analyze_sales(
+        product_id, start_date, end_date, comparison_type, is_second_product,
+        first_product_id, compare_periods, second_start_date, second_end_date
+    ))
+
+def _analyze_sales(
+    product_id, start_date, end_date, comparison_type, is_second_product,
+    first_product_id, compare_periods, second_start_date, second_end_date
+):
+    conn = get_db_connection("analytics")
     cursor = conn.cursor()
     
     try:
@@ -194,42 +1044,13 @@ def analyze_sales(
             raise HTTPException(status_code=404, detail="Produto não encontrado")
         
         if compare_periods and second_start_date and second_end_date:
-            # Lógica para comparar dois períodos
-            cursor.execute(
-                """
-                SELECT COUNT(*) AS total_ocorrencias
-                FROM itens_compra i
-                JOIN compra c ON i.id_compra = c.id_compra
-                WHERE i.id_produto = %s AND c.data_compra BETWEEN %s AND %s
-                """,
-                (product_id, start_date, end_date)
-            )
-            first_period_result = cursor.fetchone()
-            first_period_sales = first_period_result["total_ocorrencias"] if first_period_result else 0
-
-            cursor.execute(
-                """
-                SELECT COUNT(*) AS total_ocorrencias
-                FROM itens_compra i
-                JOIN compra c ON i.id_compra = c.id_compra
-                WHERE i.id_produto = %s AND c.data_compra BETWEEN %s AND %s
-                """,
-                (product_id, second_start_date, second_end_date)
+            # Lógica para comparar dois períodos (uma única varredura via motor de janelas)
+            (first_period_sales, second_period_sales), related_products = compare_windows(
+                cursor, product_id, [(start_date, end_date), (second_start_date, second_end_date)]
             )
-            second_period_result = cursor.fetchone()
-            second_period_sales = second_period_result["total_ocorrencias"] if second_period_result else 0
             
             absolute_difference = second_period_sales - first_period_sales
             percentage_difference = 0 if first_period_sales == 0 else round((absolute_difference / first_period_sales) * 100)
-
-            cursor.execute(
-                "SELECT id_compra FROM compra WHERE data_compra BETWEEN %s AND %s OR data_compra BETWEEN %s AND %s",
-                (start_date, end_date, second_start_date, second_end_date)
-            )
-            all_period_purchases = cursor.fetchall()
-            combined_purchase_ids = [p["id_compra"] for p in all_period_purchases]
-            
-            related_products = get_related_products(conn, cursor, product_id, combined_purchase_ids)
             
             return {
                 "productId": product_id,
@@ -297,38 +1118,16 @@ def analyze_sales(
                     "showComparison": True
                 }
             else:
-                # Modo ATÉ: Soma todas as vendas no intervalo
-                cursor.execute(
-                    "SELECT id_compra FROM compra WHERE data_compra >= %s AND data_compra <= %s",
-                    (start_date, end_date)
+                # Modo ATÉ: Soma todas as vendas no intervalo (mesmo motor de
+                # janelas, sem materializar as compras do período no Python)
+                (total_sales,), related_products = compare_windows(
+                    cursor, product_id, [(start_date, end_date)]
                 )
-                period_purchases = cursor.fetchall()
-                period_purchase_ids = [p["id_compra"] for p in period_purchases]
-                
-                if period_purchase_ids:
-                    cursor.execute(
-                        "SELECT id FROM itens_compra WHERE id_compra = ANY(%s) AND id_produto = %s",
-                        (period_purchase_ids, product_id)
-                    )
-                    period_items = cursor.fetchall()
-                else:
-                    period_items = []
-                
-                total_sales = len(period_items)
-                
-                related_products = get_related_products(conn, cursor, product_id, period_purchase_ids)
                 
                 if is_second_product and first_product_id:
-                    if period_purchase_ids:
-                        cursor.execute(
-                            "SELECT id FROM itens_compra WHERE id_compra = ANY(%s) AND id_produto = %s",
-                            (period_purchase_ids, first_product_id)
-                        )
-                        first_product_items = cursor.fetchall()
-                    else:
-                        first_product_items = []
-                    
-                    first_product_sales = len(first_product_items)
+                    (first_product_sales,), _ = compare_windows(
+                        cursor, first_product_id, [(start_date, end_date)], related_limit=0
+                    )
                     
                     absolute_difference = total_sales - first_product_sales
                     percentage_difference = 100 if first_product_sales == 0 else round((absolute_difference / first_product_sales) * 100)
@@ -399,8 +1198,12 @@ def get_related_products(conn, cursor, product_id, purchase_ids):
     related_products_data = []
     
     for id_produto, occurrences in product_occurrences.items():
-        cursor.execute("SELECT nome_produto FROM produto WHERE id_produto = %s", (id_produto,))
-        product = cursor.fetchone()
+        indexed = product_index.get(id_produto) if product_index.loaded else None
+        if indexed:
+            product = {"nome_produto": indexed[1]}
+        else:
+            cursor.execute("SELECT nome_produto FROM produto WHERE id_produto = %s", (id_produto,))
+            product = cursor.fetchone()
         
         related_products_data.append({
             "productName": product["nome_produto"] if product else f"Produto {id_produto}",
@@ -408,14 +1211,1326 @@ def get_related_products(conn, cursor, product_id, purchase_ids):
             "percentage": round((occurrences / total_purchases) * 100),
             "absoluteValue": occurrences,
         })
-    
-    return sorted(related_products_data, key=lambda x: x["percentage"], reverse=True)[:5]
+    
+    return sorted(related_products_data, key=lambda x: x["percentage"], reverse=True)[:5]
+
+# Motor de comparação entre N janelas de datas. As vendas do produto são lidas
+# uma única vez entre a menor e a maior data, agregadas por dia e distribuídas
+# nas janelas por um range join; o conjunto de compras dos produtos
+# relacionados também é montado uma única vez para todas as janelas.
+MAX_COMPARISON_WINDOWS = int(os.getenv("MAX_COMPARISON_WINDOWS", "60"))
+
+COMPARE_WINDOWS_SQL = """
+    WITH janelas AS (
+        SELECT * FROM unnest(%(indices)s::int[], %(inicios)s::date[], %(fins)s::date[]) AS j(idx, inicio, fim)
+    ),
+    por_compra AS (
+        -- Itens do produto por compra entre a menor e a maior data das janelas
+        {por_compra}
+    ),
+    vendas_dia AS (
+        SELECT dia, SUM(itens) AS vendas, SUM(itens * itens) AS quadrados
+        FROM por_compra
+        GROUP BY dia
+    ),
+    contagens AS (
+        SELECT j.idx, COALESCE(SUM(v.vendas), 0) AS vendas, COALESCE(SUM(v.quadrados), 0) AS quadrados
+        FROM janelas j
+        LEFT JOIN vendas_dia v ON v.dia BETWEEN j.inicio AND j.fim
+        GROUP BY j.idx
+    ),
+    compras_com_produto AS (
+        SELECT DISTINCT pc.id_compra
+        FROM por_compra pc
+        WHERE EXISTS (SELECT 1 FROM janelas j WHERE pc.dia BETWEEN j.inicio AND j.fim)
+    ),
+    relacionados AS (
+        SELECT
+            COALESCE(p.nome_produto, 'Produto ' || i.id_produto) AS "productName",
+            COUNT(DISTINCT i.id_compra) AS occurrences,
+            ROUND(COUNT(DISTINCT i.id_compra) * 100.0 / (SELECT COUNT(*) FROM compras_com_produto))::int AS percentage,
+            COUNT(DISTINCT i.id_compra) AS "absoluteValue"
+        FROM itens_compra i
+        JOIN compras_com_produto cp ON cp.id_compra = i.id_compra
+        LEFT JOIN produto p ON p.id_produto = i.id_produto
+        WHERE i.id_produto <> %(produto)s
+        GROUP BY i.id_produto, p.nome_produto
+        ORDER BY occurrences DESC, i.id_produto
+        LIMIT %(limite)s
+    )
+    SELECT
+        c.idx,
+        c.vendas,
+        c.quadrados,
+        (SELECT COALESCE(json_agg(r), '[]'::json) FROM relacionados r) AS relacionados
+    FROM contagens c
+    ORDER BY c.idx
+"""
+
+EXACT_PURCHASES_SQL = """
+        SELECT i.id_compra, c.data_compra::date AS dia, COUNT(*) AS itens
+        FROM itens_compra i
+        JOIN compra c ON i.id_compra = c.id_compra
+        WHERE i.id_produto = %(produto)s
+          AND c.data_compra BETWEEN (SELECT MIN(inicio) FROM janelas) AND (SELECT MAX(fim) FROM janelas)
+        GROUP BY i.id_compra, c.data_compra::date
+"""
+
+# No modo aproximado a amostra é de compras (cestas inteiras), então os
+# produtos relacionados saem da mesma amostra sem distorcer as proporções
+SAMPLED_PURCHASES_SQL = """
+        SELECT c.id_compra, c.data_compra::date AS dia, COUNT(*) AS itens
+        FROM compra c TABLESAMPLE {metodo} (%(percentual)s) REPEATABLE (%(semente)s)
+        JOIN itens_compra i ON i.id_compra = c.id_compra AND i.id_produto = %(produto)s
+        WHERE c.data_compra BETWEEN (SELECT MIN(inicio) FROM janelas) AND (SELECT MAX(fim) FROM janelas)
+        GROUP BY c.id_compra, c.data_compra::date
+"""
+
+
+def compare_windows(cursor, product_id, windows, related_limit=5):
+    """Conta as vendas do produto em cada janela (inicio, fim) e calcula os relacionados.
+
+    Retorna a lista de vendas na ordem das janelas e os produtos relacionados
+    considerando as compras de todas as janelas juntas.
+    """
+    cursor.execute(COMPARE_WINDOWS_SQL.format(por_compra=EXACT_PURCHASES_SQL), {
+        "indices": list(range(len(windows))),
+        "inicios": [start for start, _ in windows],
+        "fins": [end for _, end in windows],
+        "produto": product_id,
+        "limite": related_limit,
+    })
+    rows = cursor.fetchall()
+    sales = [int(row["vendas"]) for row in rows]
+    related_products = rows[0]["relacionados"] if rows else []
+    return sales, related_products
+
+
+# Modo aproximado (approx=true) para intervalos muito longos: as contagens saem
+# de uma amostra de compras via TABLESAMPLE e são escaladas pela fração
+# amostrada, com intervalo de confiança de 95%. O modo exato continua o padrão.
+# O padrão é SYSTEM: BERNOULLI sorteia linha a linha e por isso lê todas as
+# páginas de compra, o que não ganha do modo exato (índice de id_produto).
+APPROX_SAMPLE_PERCENT = float(os.getenv("APPROX_SAMPLE_PERCENT", "1"))
+APPROX_SAMPLE_METHOD = os.getenv("APPROX_SAMPLE_METHOD", "SYSTEM").upper()
+APPROX_SAMPLE_SEED = int(os.getenv("APPROX_SAMPLE_SEED", "42"))
+APPROX_Z = 1.96
+
+if APPROX_SAMPLE_METHOD not in ("BERNOULLI", "SYSTEM"):
+    raise RuntimeError("APPROX_SAMPLE_METHOD deve ser BERNOULLI ou SYSTEM")
+
+
+def scale_estimate(sampled, squares):
+    """Estimativa do total e limites de 95% a partir de uma amostra de cestas.
+
+    Cada compra entra na amostra com probabilidade f; o total é estimado por
+    soma/f e a variância por (1 - f) / f² · Σx², onde x é o número de itens do
+    produto em cada compra amostrada. Com SYSTEM (amostra por bloco) as compras
+    deixam de ser independentes e os limites ficam otimistas.
+
+    Sem nenhuma venda na amostra a variância estimada é zero; nesse caso o
+    limite superior segue a regra de três (3/f compras).
+    """
+    f = APPROX_SAMPLE_PERCENT / 100
+    estimate = sampled / f
+    if sampled == 0:
+        return 0, {"lower": 0, "upper": math.ceil(3 / f)}
+    margin = APPROX_Z * (((1 - f) / (f * f)) * squares) ** 0.5
+    return round(estimate), {"lower": max(0, int(estimate - margin)), "upper": int(round(estimate + margin + 0.5))}
+
+
+def approximation_info(start_bounds, end_bounds):
+    return {
+        "method": f"tablesample-{APPROX_SAMPLE_METHOD.lower()}",
+        "samplePercent": APPROX_SAMPLE_PERCENT,
+        "confidence": 0.95,
+        "startDateSales": start_bounds,
+        "endDateSales": end_bounds,
+    }
+
+
+def compare_windows_approx(cursor, product_id, windows, related_limit=5):
+    """Versão amostrada de compare_windows: devolve estimativas, limites e relacionados."""
+    cursor.execute(
+        COMPARE_WINDOWS_SQL.format(por_compra=SAMPLED_PURCHASES_SQL.format(metodo=APPROX_SAMPLE_METHOD)),
+        {
+            "indices": list(range(len(windows))),
+            "inicios": [start for start, _ in windows],
+            "fins": [end for _, end in windows],
+            "produto": product_id,
+            "limite": related_limit,
+            "percentual": APPROX_SAMPLE_PERCENT,
+            "semente": APPROX_SAMPLE_SEED,
+        }
+    )
+    rows = cursor.fetchall()
+    estimates = [scale_estimate(int(row["vendas"]), int(row["quadrados"])) for row in rows]
+    related_products = rows[0]["relacionados"] if rows else []
+    return [e for e, _ in estimates], [b for _, b in estimates], related_products
+
+
+def _analyze_sales_approx(
+    product_id, start_date, end_date, comparison_type, is_second_product,
+    first_product_id, compare_periods, second_start_date, second_end_date
+):
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT id_produto, nome_produto FROM produto WHERE id_produto = %s", (product_id,))
+        product = cursor.fetchone()
+        if not product:
+            raise HTTPException(status_code=404, detail="Produto não encontrado")
+
+        show_comparison = True
+        if compare_periods and second_start_date and second_end_date:
+            windows = [(start_date, end_date), (second_start_date, second_end_date)]
+        elif comparison_type.lower() == "compare":
+            windows = [(start_date, start_date), (end_date, end_date)]
+        else:
+            windows = [(start_date, end_date)]
+
+        sales, bounds, related_products = compare_windows_approx(cursor, product_id, windows)
+
+        if len(windows) == 2:
+            start_sales, end_sales = sales
+            start_bounds, end_bounds = bounds
+        elif is_second_product and first_product_id:
+            first_sales, first_bounds, _ = compare_windows_approx(cursor, first_product_id, windows, related_limit=0)
+            start_sales, start_bounds = first_sales[0], first_bounds[0]
+            end_sales, end_bounds = sales[0], bounds[0]
+        else:
+            show_comparison = False
+            start_sales, start_bounds = 0, {"lower": 0, "upper": 0}
+            end_sales, end_bounds = sales[0], bounds[0]
+    finally:
+        cursor.close()
+        conn.close()
+
+    if show_comparison:
+        difference = sales_difference(start_sales, end_sales)
+        if len(windows) == 1 and start_sales == 0:
+            # Mesma regra do modo exato ao comparar com o primeiro produto
+            difference["percentage"] = 100
+    else:
+        difference = {"percentage": 0, "absoluteValue": end_sales, "isIncrease": True}
+
+    return {
+        "productId": product_id,
+        "productName": product["nome_produto"],
+        "startDateSales": start_sales,
+        "endDateSales": end_sales,
+        "salesDifference": difference,
+        "relatedProducts": related_products,
+        "showComparison": show_comparison,
+        "approximation": approximation_info(start_bounds, end_bounds),
+    }
+
+
+def sales_difference(before, after):
+    absolute_difference = after - before
+    percentage_difference = 0 if before == 0 else round((absolute_difference / before) * 100)
+    return {
+        "percentage": abs(percentage_difference),
+        "absoluteValue": abs(absolute_difference),
+        "isIncrease": absolute_difference >= 0,
+    }
+
+
+def shift_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    next_month = date(year + (month == 12), month % 12 + 1, 1)
+    last_day = (next_month - timedelta(days=1)).day
+    return date(year, month, min(day.day, last_day))
+
+
+def build_windows(windows, preset, start_date, end_date, count):
+    if windows:
+        parsed = []
+        for window in windows.split(","):
+            start, sep, end = window.partition(":")
+            if not sep:
+                raise HTTPException(status_code=400, detail="Cada janela deve estar no formato inicio:fim")
+            parsed.append((parse_iso_date(start.strip(), "windows"), parse_iso_date(end.strip(), "windows")))
+    elif preset:
+        if not start_date or not end_date:
+            raise HTTPException(status_code=400, detail="Informe start_date e end_date da janela mais recente")
+        if preset not in ("monthly", "yearly"):
+            raise HTTPException(status_code=400, detail="preset deve ser monthly ou yearly")
+        start = parse_iso_date(start_date, "start_date")
+        end = parse_iso_date(end_date, "end_date")
+        step = 12 if preset == "yearly" else 1
+        # Da janela mais antiga para a mais recente
+        parsed = [
+            (shift_months(start, -step * k), shift_months(end, -step * k))
+            for k in range(count - 1, -1, -1)
+        ]
+    else:
+        raise HTTPException(status_code=400, detail="Informe windows ou preset")
+
+    if not parsed or len(parsed) > MAX_COMPARISON_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"Informe entre 1 e {MAX_COMPARISON_WINDOWS} janelas")
+    for start, end in parsed:
+        if start > end:
+            raise HTTPException(status_code=400, detail="Início da janela posterior ao fim")
+    return parsed
+
+
+@router.get("/analysis/sales/periods")
+def analyze_sales_periods(
+    product_id: int,
+    windows: Optional[str] = None,
+    preset: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    count: int = 12
+):
+    parsed = build_windows(windows, preset and preset.lower(), start_date, end_date, count)
+    key = flight_key("analysis_sales_periods", product_id=product_id, windows=tuple(parsed))
+    return single_flight.do(key, lambda: _analyze_sales_periods(product_id, parsed))
+
+def _analyze_sales_periods(product_id, windows):
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT id_produto, nome_produto FROM produto WHERE id_produto = %s", (product_id,))
+        product = cursor.fetchone()
+        if not product:
+            raise HTTPException(status_code=404, detail="Produto não encontrado")
+
+        sales, related_products = compare_windows(cursor, product_id, windows)
+    finally:
+        cursor.close()
+        conn.close()
+
+    results = []
+    for index, ((start, end), window_sales) in enumerate(zip(windows, sales)):
+        results.append({
+            "index": index,
+            "startDate": start.isoformat(),
+            "endDate": end.isoformat(),
+            "sales": window_sales,
+            "differenceFromPrevious": sales_difference(sales[index - 1], window_sales) if index else None,
+            "differenceFromFirst": sales_difference(sales[0], window_sales) if index else None,
+        })
+
+    return {
+        "productId": product_id,
+        "productName": product["nome_produto"],
+        "windows": results,
+        "relatedProducts": related_products,
+    }
+
+# Curva ABC (Pareto) do catálogo: uma varredura agrupada das vendas do período,
+# participação acumulada por funções de janela e faixa de margem a partir do
+# mark-up ponderado do estoque. O resultado fica em cache por período; períodos
+# já encerrados não mudam e ficam mais tempo.
+ABC_CACHE_TTL = float(os.getenv("ABC_CACHE_TTL", "3600"))
+ABC_CLOSED_PERIOD_CACHE_TTL = float(os.getenv("ABC_CLOSED_PERIOD_CACHE_TTL", "86400"))
+MARGIN_BANDS = tuple(float(v) for v in os.getenv("MARGIN_BANDS", "20,50").split(","))
+
+ABC_SQL = """
+    WITH vendas AS (
+        SELECT i.id_produto, COUNT(*) AS unidades, COALESCE(SUM(i.valor_unitario), 0) AS receita
+        FROM itens_compra i
+        JOIN compra c ON i.id_compra = c.id_compra
+        WHERE c.data_compra BETWEEN %(inicio)s AND %(fim)s
+        GROUP BY i.id_produto
+    ),
+    ranking AS (
+        SELECT
+            v.*,
+            RANK() OVER (ORDER BY receita DESC) AS posicao_receita,
+            RANK() OVER (ORDER BY unidades DESC) AS posicao_unidades,
+            receita / NULLIF(SUM(receita) OVER (), 0) AS participacao_receita,
+            unidades::numeric / NULLIF(SUM(unidades) OVER (), 0) AS participacao_unidades,
+            SUM(receita) OVER (ORDER BY receita DESC, id_produto ROWS UNBOUNDED PRECEDING)
+                / NULLIF(SUM(receita) OVER (), 0) AS acumulado_receita,
+            SUM(unidades) OVER (ORDER BY unidades DESC, id_produto ROWS UNBOUNDED PRECEDING)::numeric
+                / NULLIF(SUM(unidades) OVER (), 0) AS acumulado_unidades
+        FROM vendas v
+    ),
+    vendas_lote AS (
+        -- Sem juntar com estoque: um lote com várias movimentações multiplicaria as vendas
+        SELECT lote, COUNT(*) AS vendidos
+        FROM itens_compra
+        WHERE lote IS NOT NULL
+        GROUP BY lote
+    ),
+    markup_produto AS (
+        -- Mesmo mark-up ponderado pela quantidade disponível de /api/markup
+        SELECT
+            e.id_produto,
+            ROUND(
+                SUM(((p.preco - e.valor_unitario) / e.valor_unitario) * 100 * (e.quantidade - COALESCE(vl.vendidos, 0)))
+                / SUM(e.quantidade - COALESCE(vl.vendidos, 0)),
+                2
+            ) AS markup
+        FROM estoque e
+        JOIN produto p ON p.id_produto = e.id_produto
+        LEFT JOIN vendas_lote vl ON vl.lote = e.lote
+        WHERE e.quantidade - COALESCE(vl.vendidos, 0) > 0
+        GROUP BY e.id_produto
+    )
+    SELECT
+        r.id_produto,
+        p.nome_produto,
+        r.unidades,
+        r.receita,
+        r.posicao_receita,
+        r.posicao_unidades,
+        r.participacao_receita,
+        r.participacao_unidades,
+        r.acumulado_receita,
+        r.acumulado_unidades,
+        -- A classe considera a participação acumulada antes do produto, para
+        -- que o item que cruza o limite ainda entre na classe
+        CASE
+            WHEN r.acumulado_receita - r.participacao_receita < %(limite_a)s THEN 'A'
+            WHEN r.acumulado_receita - r.participacao_receita < %(limite_b)s THEN 'B'
+            ELSE 'C'
+        END AS classe_receita,
+        CASE
+            WHEN r.acumulado_unidades - r.participacao_unidades < %(limite_a)s THEN 'A'
+            WHEN r.acumulado_unidades - r.participacao_unidades < %(limite_b)s THEN 'B'
+            ELSE 'C'
+        END AS classe_unidades,
+        m.markup
+    FROM ranking r
+    JOIN produto p ON p.id_produto = r.id_produto
+    LEFT JOIN markup_produto m ON m.id_produto = r.id_produto
+    ORDER BY r.posicao_receita, r.id_produto
+"""
+
+
+def margin_band(markup):
+    if markup is None:
+        return None
+    low, high = MARGIN_BANDS
+    if markup < low:
+        return "low"
+    if markup < high:
+        return "medium"
+    return "high"
+
+
+def compute_abc(start, end, a_share, b_share):
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
+    try:
+        cursor.execute(ABC_SQL, {"inicio": start, "fim": end, "limite_a": a_share, "limite_b": b_share})
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+    items = []
+    summary = {cls: {"products": 0, "revenue": 0.0, "units": 0} for cls in "ABC"}
+    for row in rows:
+        markup = float(row["markup"]) if row["markup"] is not None else None
+        item = {
+            "productId": row["id_produto"],
+            "productName": row["nome_produto"],
+            "units": int(row["unidades"]),
+            "revenue": float(row["receita"]),
+            "revenueRank": int(row["posicao_receita"]),
+            "unitsRank": int(row["posicao_unidades"]),
+            "revenueShare": float(row["participacao_receita"] or 0),
+            "unitsShare": float(row["participacao_unidades"] or 0),
+            "cumulativeRevenueShare": float(row["acumulado_receita"] or 0),
+            "cumulativeUnitsShare": float(row["acumulado_unidades"] or 0),
+            "revenueClass": row["classe_receita"],
+            "unitsClass": row["classe_unidades"],
+            "markup": markup,
+            "marginBand": margin_band(markup),
+        }
+        items.append(item)
+        totals = summary[item["revenueClass"]]
+        totals["products"] += 1
+        totals["revenue"] += item["revenue"]
+        totals["units"] += item["units"]
+
+    return {
+        "startDate": start.isoformat(),
+        "endDate": end.isoformat(),
+        "aShare": a_share,
+        "bShare": b_share,
+        "summary": summary,
+        "items": items,
+    }
+
+
+@router.get("/analysis/abc")
+def get_abc_analysis(start_date: str, end_date: str, a_share: float = 0.8, b_share: float = 0.95):
+    start = parse_iso_date(start_date, "start_date")
+    end = parse_iso_date(end_date, "end_date")
+    if start > end:
+        raise HTTPException(status_code=400, detail="start_date posterior a end_date")
+    if not 0 < a_share < b_share <= 1:
+        raise HTTPException(status_code=400, detail="Use 0 < a_share < b_share <= 1")
+
+    max_age = ABC_CLOSED_PERIOD_CACHE_TTL if end < date.today() else ABC_CACHE_TTL
+    key = f"abc:{start.isoformat()}:{end.isoformat()}:{a_share}:{b_share}"
+    return cached_result("abc", key, max_age, lambda: compute_abc(start, end, a_share, b_share))
+
+# Impacto de encarte (itens_compra.encarte): vendas nos dias de encarte contra
+# uma linha de base por produto e dia da semana calculada só com dias sem
+# encarte, mais o efeito halo na cesta (itens e receita dos outros produtos nas
+# compras que levaram o item). A linha de base é pré-calculada pelo agendador
+# na tabela baseline_encarte, então o relatório inteiro sai numa consulta.
+# A base cobre só a janela registrada em baseline_encarte_estado; períodos que
+# começam antes dela são recusados em vez de comparados com médias atuais.
+# Enquanto o agendador não calculou a primeira base, o relatório devolve 503.
+PROMOTION_BASELINE_DAYS = int(os.getenv("PROMOTION_BASELINE_DAYS", "180"))
+
+ENCARTE_ATIVO_SQL = "(NULLIF(TRIM(i.encarte), '') IS NOT NULL AND UPPER(TRIM(i.encarte)) NOT IN ('N', 'NAO', 'NÃO', '0', 'FALSE', 'F'))"
+
+PROMOTION_BASELINE_DDL = """
+    CREATE TABLE IF NOT EXISTS baseline_encarte (
+        id_produto INTEGER NOT NULL,
+        dia_semana SMALLINT NOT NULL,
+        dias INTEGER NOT NULL,
+        unidades_media NUMERIC NOT NULL,
+        receita_media NUMERIC NOT NULL,
+        outros_itens_media NUMERIC,
+        outra_receita_media NUMERIC,
+        atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (id_produto, dia_semana)
+    );
+    CREATE TABLE IF NOT EXISTS baseline_encarte_estado (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        inicio DATE NOT NULL,
+        fim DATE NOT NULL,
+        atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+PROMOTION_ITEMS_SQL = """
+    itens AS (
+        SELECT i.id_compra, i.id_produto, i.valor_unitario, c.data_compra::date AS dia,
+               """ + ENCARTE_ATIVO_SQL + """ AS promo
+        FROM itens_compra i
+        JOIN compra c ON i.id_compra = c.id_compra
+        WHERE c.data_compra >= %(inicio)s AND c.data_compra < %(fim)s
+    ),
+    dias_promo AS (
+        SELECT DISTINCT id_produto, dia FROM itens WHERE promo
+    ),
+    cestas AS (
+        SELECT id_compra, COUNT(*) AS itens, SUM(valor_unitario) AS receita
+        FROM itens
+        GROUP BY id_compra
+    ),
+    produto_cesta AS (
+        -- Uma linha por produto e compra, com o que sobra da cesta sem ele
+        SELECT pc.id_produto, pc.id_compra, pc.dia,
+               c.itens - pc.itens AS outros_itens,
+               c.receita - pc.receita AS outra_receita
+        FROM (
+            SELECT id_produto, id_compra, dia, COUNT(*) AS itens, SUM(valor_unitario) AS receita
+            FROM itens
+            GROUP BY id_produto, id_compra, dia
+        ) pc
+        JOIN cestas c ON c.id_compra = pc.id_compra
+    )
+"""
+
+PROMOTION_BASELINE_SQL = """
+    WITH """ + PROMOTION_ITEMS_SQL + """,
+    calendario AS (
+        SELECT EXTRACT(ISODOW FROM d)::int AS dia_semana, COUNT(*) AS dias
+        FROM generate_series(%(inicio)s::date, %(fim)s::date - 1, INTERVAL '1 day') d
+        GROUP BY 1
+    ),
+    produtos AS (
+        SELECT DISTINCT id_produto FROM itens
+    ),
+    promo_semana AS (
+        SELECT id_produto, EXTRACT(ISODOW FROM dia)::int AS dia_semana, COUNT(*) AS dias
+        FROM dias_promo
+        GROUP BY 1, 2
+    ),
+    normais AS (
+        -- Vendas fora dos dias em que o próprio produto esteve em encarte
+        SELECT it.id_produto, EXTRACT(ISODOW FROM it.dia)::int AS dia_semana,
+               COUNT(*) AS unidades, SUM(it.valor_unitario) AS receita
+        FROM itens it
+        LEFT JOIN dias_promo dp ON dp.id_produto = it.id_produto AND dp.dia = it.dia
+        WHERE dp.id_produto IS NULL
+        GROUP BY 1, 2
+    ),
+    halo_normal AS (
+        SELECT pc.id_produto, EXTRACT(ISODOW FROM pc.dia)::int AS dia_semana,
+               AVG(pc.outros_itens) AS outros_itens, AVG(pc.outra_receita) AS outra_receita
+        FROM produto_cesta pc
+        LEFT JOIN dias_promo dp ON dp.id_produto = pc.id_produto AND dp.dia = pc.dia
+        WHERE dp.id_produto IS NULL
+        GROUP BY 1, 2
+    )
+    INSERT INTO baseline_encarte (
+        id_produto, dia_semana, dias, unidades_media, receita_media, outros_itens_media, outra_receita_media
+    )
+    SELECT
+        p.id_produto,
+        cal.dia_semana,
+        cal.dias - COALESCE(ps.dias, 0),
+        COALESCE(n.unidades, 0)::numeric / NULLIF(cal.dias - COALESCE(ps.dias, 0), 0),
+        COALESCE(n.receita, 0) / NULLIF(cal.dias - COALESCE(ps.dias, 0), 0),
+        h.outros_itens,
+        h.outra_receita
+    FROM produtos p
+    CROSS JOIN calendario cal
+    LEFT JOIN promo_semana ps ON ps.id_produto = p.id_produto AND ps.dia_semana = cal.dia_semana
+    LEFT JOIN normais n ON n.id_produto = p.id_produto AND n.dia_semana = cal.dia_semana
+    LEFT JOIN halo_normal h ON h.id_produto = p.id_produto AND h.dia_semana = cal.dia_semana
+    WHERE cal.dias - COALESCE(ps.dias, 0) > 0
+"""
+
+PROMOTION_REPORT_SQL = """
+    WITH """ + PROMOTION_ITEMS_SQL + """,
+    dias_promo_filtrados AS (
+        SELECT * FROM dias_promo
+        WHERE %(produtos)s::int[] IS NULL OR id_produto = ANY(%(produtos)s::int[])
+    ),
+    vendas_promo AS (
+        SELECT dp.id_produto, COUNT(DISTINCT dp.dia) AS dias, COUNT(*) AS unidades, SUM(it.valor_unitario) AS receita
+        FROM dias_promo_filtrados dp
+        JOIN itens it ON it.id_produto = dp.id_produto AND it.dia = dp.dia
+        GROUP BY dp.id_produto
+    ),
+    esperado AS (
+        SELECT dp.id_produto,
+               SUM(b.unidades_media) AS unidades,
+               SUM(b.receita_media) AS receita,
+               AVG(b.outros_itens_media) AS outros_itens,
+               AVG(b.outra_receita_media) AS outra_receita,
+               COUNT(b.id_produto) AS dias_com_base
+        FROM dias_promo_filtrados dp
+        LEFT JOIN baseline_encarte b ON b.id_produto = dp.id_produto AND b.dia_semana = EXTRACT(ISODOW FROM dp.dia)
+        GROUP BY dp.id_produto
+    ),
+    halo_promo AS (
+        SELECT pc.id_produto, COUNT(*) AS cestas,
+               AVG(pc.outros_itens) AS outros_itens, AVG(pc.outra_receita) AS outra_receita
+        FROM produto_cesta pc
+        JOIN dias_promo_filtrados dp ON dp.id_produto = pc.id_produto AND dp.dia = pc.dia
+        GROUP BY pc.id_produto
+    )
+    SELECT
+        v.id_produto, p.nome_produto, v.dias, v.unidades, v.receita,
+        e.unidades AS unidades_base, e.receita AS receita_base, e.dias_com_base,
+        h.cestas, h.outros_itens, h.outra_receita,
+        e.outros_itens AS outros_itens_base, e.outra_receita AS outra_receita_base
+    FROM vendas_promo v
+    JOIN produto p ON p.id_produto = v.id_produto
+    LEFT JOIN esperado e ON e.id_produto = v.id_produto
+    LEFT JOIN halo_promo h ON h.id_produto = v.id_produto
+    ORDER BY v.receita - COALESCE(e.receita, 0) DESC
+"""
+
+
+def refresh_promotion_baseline(conn):
+    """Recalcula baseline_encarte com os últimos PROMOTION_BASELINE_DAYS dias completos.
+
+    Roda só no agendador, na conexão de jobs: a varredura de meses de
+    itens_compra não cabe no statement_timeout das classes das rotas.
+    """
+    end = date.today()
+    start = end - timedelta(days=PROMOTION_BASELINE_DAYS)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(PROMOTION_BASELINE_DDL)
+        # Na mesma transação: quem lê continua vendo a base anterior até o commit
+        cursor.execute("DELETE FROM baseline_encarte")
+        cursor.execute(PROMOTION_BASELINE_SQL, {"inicio": start, "fim": end})
+        rows = cursor.rowcount
+        cursor.execute(
+            """
+            INSERT INTO baseline_encarte_estado (inicio, fim) VALUES (%s, %s)
+            ON CONFLICT (id) DO UPDATE SET inicio = EXCLUDED.inicio, fim = EXCLUDED.fim, atualizado_em = now()
+            """,
+            (start, end)
+        )
+        conn.commit()
+    finally:
+        cursor.close()
+    return {"startDate": start.isoformat(), "endDate": end.isoformat(), "rows": rows}
+
+
+def _read_promotion_baseline_window():
+    # No primário, como o estado do resumo de clientes
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT to_regclass('baseline_encarte_estado') IS NOT NULL AS existe")
+        if not cursor.fetchone()["existe"]:
+            return None
+        cursor.execute("SELECT inicio, fim FROM baseline_encarte_estado")
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def promotion_baseline_window():
+    """Janela (início, fim exclusivo) da linha de base; 503 enquanto ela não foi calculada."""
+    row = _read_promotion_baseline_window()
+    if row is None:
+        # O cálculo é do agendador: só antecipa a próxima execução do job
+        scheduler.request_run("promotion_baseline")
+        raise HTTPException(status_code=503, detail="Linha de base de encarte em construção, tente novamente em instantes")
+    return row["inicio"], row["fim"]
+
+
+def _ratio(value, base):
+    return round(value / base - 1, 4) if base else None
+
+
+@router.get("/analysis/promotions")
+def get_promotion_impact(start_date: str, end_date: str, product_ids: Optional[str] = None):
+    start = parse_iso_date(start_date, "start_date")
+    end = parse_iso_date(end_date, "end_date")
+    if start > end:
+        raise HTTPException(status_code=400, detail="start_date posterior a end_date")
+    ids = None
+    if product_ids:
+        try:
+            ids = [int(id) for id in product_ids.split(",") if id.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="product_ids deve ser uma lista de números separados por vírgula")
+
+    baseline_start, baseline_end = promotion_baseline_window()
+    if start < baseline_start:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A linha de base de encarte cobre a partir de {baseline_start.isoformat()}; use um período posterior"
+        )
+    key = flight_key("promotion_report", start_date=start, end_date=end, product_ids=tuple(ids or ()))
+    return single_flight.do(key, lambda: _promotion_report(start, end, ids, baseline_start, baseline_end))
+
+
+def _promotion_report(start, end, ids, baseline_start, baseline_end):
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
+    try:
+        cursor.execute(PROMOTION_REPORT_SQL, {"inicio": start, "fim": end + timedelta(days=1), "produtos": ids})
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+    items = []
+    for row in rows:
+        units = int(row["unidades"])
+        revenue = float(row["receita"] or 0)
+        baseline_units = float(row["unidades_base"] or 0)
+        baseline_revenue = float(row["receita_base"] or 0)
+        baskets = int(row["cestas"] or 0)
+        other_revenue = float(row["outra_receita"] or 0)
+        baseline_other_revenue = float(row["outra_receita_base"]) if row["outra_receita_base"] is not None else None
+        items.append({
+            "productId": row["id_produto"],
+            "productName": row["nome_produto"],
+            "promoDays": int(row["dias"]),
+            "daysWithBaseline": int(row["dias_com_base"] or 0),
+            "units": units,
+            "revenue": round(revenue, 2),
+            "baselineUnits": round(baseline_units, 2),
+            "baselineRevenue": round(baseline_revenue, 2),
+            "incrementalUnits": round(units - baseline_units, 2),
+            "incrementalRevenue": round(revenue - baseline_revenue, 2),
+            "unitsLift": _ratio(units, baseline_units),
+            "revenueLift": _ratio(revenue, baseline_revenue),
+            "halo": {
+                "baskets": baskets,
+                "avgOtherItems": round(float(row["outros_itens"] or 0), 2),
+                "baselineAvgOtherItems": round(float(row["outros_itens_base"]), 2) if row["outros_itens_base"] is not None else None,
+                "avgOtherRevenue": round(other_revenue, 2),
+                "baselineAvgOtherRevenue": round(baseline_other_revenue, 2) if baseline_other_revenue is not None else None,
+                "incrementalBasketRevenue": (
+                    round((other_revenue - baseline_other_revenue) * baskets, 2)
+                    if baseline_other_revenue is not None else None
+                ),
+            },
+        })
+
+    return {
+        "startDate": start.isoformat(),
+        "endDate": end.isoformat(),
+        "baselineStartDate": baseline_start.isoformat(),
+        "baselineEndDate": (baseline_end - timedelta(days=1)).isoformat(),
+        "items": items,
+    }
+
+
+# Clientes (compra.cpf): linha do tempo de compras por cliente e resumo
+# (primeira/última compra, frequência e valor) em tabelas próprias, mantidas
+# de forma incremental a partir do último id_compra processado. Coortes, RFM e
+# retorno após a compra de um produto saem dessas tabelas sem reler compra.
+# Supõe que uma compra e seus itens são gravados juntos e não mudam depois.
+# Os ids são atribuídos no INSERT mas ficam visíveis no commit, fora de ordem;
+# por isso cada atualização relê os CUSTOMER_RESCAN_IDS ids abaixo da marca e
+# aplica só as compras que ainda não estão em compra_cliente.
+# Só o agendador monta o resumo, em lotes de CUSTOMER_BATCH_IDS ids; até a
+# primeira carga terminar (estado.completo) as rotas de clientes devolvem 503.
+CUSTOMER_CACHE_TTL = float(os.getenv("CUSTOMER_CACHE_TTL", "300"))
+CUSTOMER_RESCAN_IDS = int(os.getenv("CUSTOMER_RESCAN_IDS", "10000"))
+CUSTOMER_BATCH_IDS = int(os.getenv("CUSTOMER_BATCH_IDS", "50000"))
+
+CUSTOMER_SUMMARY_DDL = """
+    CREATE TABLE IF NOT EXISTS compra_cliente (
+        id_compra INTEGER PRIMARY KEY,
+        cpf TEXT NOT NULL,
+        data_compra DATE NOT NULL,
+        valor NUMERIC NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_compra_cliente_cpf_data ON compra_cliente (cpf, data_compra, id_compra);
+    CREATE TABLE IF NOT EXISTS resumo_cliente (
+        cpf TEXT PRIMARY KEY,
+        primeira_compra DATE NOT NULL,
+        ultima_compra DATE NOT NULL,
+        compras INTEGER NOT NULL,
+        valor_total NUMERIC NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_resumo_cliente_primeira ON resumo_cliente (primeira_compra);
+    CREATE TABLE IF NOT EXISTS atividade_cliente_mes (
+        cpf TEXT NOT NULL,
+        mes DATE NOT NULL,
+        compras INTEGER NOT NULL,
+        valor NUMERIC NOT NULL,
+        PRIMARY KEY (cpf, mes)
+    );
+    CREATE TABLE IF NOT EXISTS resumo_cliente_estado (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        ultimo_id_compra INTEGER NOT NULL,
+        completo BOOLEAN NOT NULL DEFAULT FALSE,
+        atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    INSERT INTO resumo_cliente_estado (ultimo_id_compra) VALUES (0) ON CONFLICT DO NOTHING;
+"""
+
+CUSTOMER_NEW_PURCHASES_SQL = """
+    CREATE TEMP TABLE novas_compras ON COMMIT DROP AS
+    SELECT c.id_compra, TRIM(c.cpf) AS cpf, c.data_compra::date AS data_compra,
+           COALESCE(SUM(i.valor_unitario), 0) AS valor
+    FROM compra c
+    LEFT JOIN itens_compra i ON i.id_compra = c.id_compra
+    WHERE c.id_compra > %(desde)s AND c.id_compra <= %(ate)s
+      AND NULLIF(TRIM(c.cpf), '') IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM compra_cliente cc WHERE cc.id_compra = c.id_compra)
+    GROUP BY c.id_compra
+"""
+
+CUSTOMER_APPLY_SQL = """
+    INSERT INTO compra_cliente (id_compra, cpf, data_compra, valor)
+    SELECT id_compra, cpf, data_compra, valor FROM novas_compras
+    ON CONFLICT (id_compra) DO NOTHING;
+
+    INSERT INTO resumo_cliente AS r (cpf, primeira_compra, ultima_compra, compras, valor_total)
+    SELECT cpf, MIN(data_compra), MAX(data_compra), COUNT(*), SUM(valor)
+    FROM novas_compras
+    GROUP BY cpf
+    ON CONFLICT (cpf) DO UPDATE SET
+        primeira_compra = LEAST(r.primeira_compra, EXCLUDED.primeira_compra),
+        ultima_compra = GREATEST(r.ultima_compra, EXCLUDED.ultima_compra),
+        compras = r.compras + EXCLUDED.compras,
+        valor_total = r.valor_total + EXCLUDED.valor_total;
+
+    INSERT INTO atividade_cliente_mes AS a (cpf, mes, compras, valor)
+    SELECT cpf, date_trunc('month', data_compra)::date, COUNT(*), SUM(valor)
+    FROM novas_compras
+    GROUP BY 1, 2
+    ON CONFLICT (cpf, mes) DO UPDATE SET
+        compras = a.compras + EXCLUDED.compras,
+        valor = a.valor + EXCLUDED.valor;
+"""
+
+CUSTOMER_COHORTS_SQL = """
+    WITH coortes AS (
+        SELECT cpf, date_trunc('month', primeira_compra)::date AS coorte
+        FROM resumo_cliente
+        WHERE primeira_compra >= %(inicio)s AND primeira_compra < %(fim)s
+    )
+    SELECT c.coorte,
+           ((EXTRACT(YEAR FROM a.mes) - EXTRACT(YEAR FROM c.coorte)) * 12
+            + EXTRACT(MONTH FROM a.mes) - EXTRACT(MONTH FROM c.coorte))::int AS periodo,
+           COUNT(*) AS clientes,
+           SUM(a.valor) AS valor
+    FROM coortes c
+    JOIN atividade_cliente_mes a ON a.cpf = c.cpf
+    WHERE a.mes < c.coorte + make_interval(months => %(periodos)s)
+    GROUP BY 1, 2
+    ORDER BY 1, 2
+"""
+
+# Notas de 1 a 5 por quintil; recência menor é melhor, então ela é ordenada
+# pela última compra em ordem crescente (quintil 5 = compraram mais recente).
+# Para uma data de referência passada, R/F/M saem da linha do tempo cortada
+# na data; do contrário, direto do resumo.
+CUSTOMER_RFM_SQL = """
+    WITH clientes AS ({clientes}),
+    notas AS (
+        SELECT cpf, ultima_compra, compras, valor_total,
+               NTILE(5) OVER (ORDER BY ultima_compra) AS r,
+               NTILE(5) OVER (ORDER BY compras) AS f,
+               NTILE(5) OVER (ORDER BY valor_total) AS m
+        FROM clientes
+    )
+    SELECT r, f, m, COUNT(*) AS clientes,
+           SUM(%(referencia)s::date - ultima_compra) AS recencia_total,
+           SUM(compras) AS compras,
+           SUM(valor_total) AS valor
+    FROM notas
+    GROUP BY r, f, m
+"""
+
+RFM_FROM_SUMMARY_SQL = """
+        SELECT cpf, ultima_compra, compras, valor_total
+        FROM resumo_cliente
+"""
+
+RFM_UNTIL_REFERENCE_SQL = """
+        SELECT cpf, MAX(data_compra) AS ultima_compra, COUNT(*) AS compras, SUM(valor) AS valor_total
+        FROM compra_cliente
+        WHERE data_compra <= %(referencia)s
+        GROUP BY cpf
+"""
+
+CUSTOMER_RETURNING_SQL = """
+    WITH compras_produto AS (
+        SELECT DISTINCT cc.id_compra, cc.cpf, cc.data_compra
+        FROM itens_compra i
+        JOIN compra_cliente cc ON cc.id_compra = i.id_compra
+        WHERE i.id_produto = %(produto)s
+          AND cc.data_compra >= %(inicio)s AND cc.data_compra <= %(fim)s
+    ),
+    retornos AS (
+        SELECT cp.cpf, r.data_compra - cp.data_compra AS dias
+        FROM compras_produto cp
+        LEFT JOIN LATERAL (
+            SELECT n.data_compra
+            FROM compra_cliente n
+            WHERE n.cpf = cp.cpf
+              AND (n.data_compra, n.id_compra) > (cp.data_compra, cp.id_compra)
+              AND n.data_compra <= cp.data_compra + %(dias)s
+            ORDER BY n.data_compra, n.id_compra
+            LIMIT 1
+        ) r ON true
+    )
+    SELECT COUNT(*) AS compras,
+           COUNT(dias) AS compras_com_retorno,
+           COUNT(DISTINCT cpf) AS clientes,
+           COUNT(DISTINCT cpf) FILTER (WHERE dias IS NOT NULL) AS clientes_com_retorno,
+           AVG(dias) AS media_dias
+    FROM retornos
+"""
+
+
+def rfm_segment(r, f):
+    """Segmento RFM pelas notas de recência e frequência."""
+    if r >= 4 and f >= 4:
+        return "champions"
+    if f >= 4:
+        return "loyal"
+    if r >= 4 and f <= 1:
+        return "new"
+    if r >= 3:
+        return "potential"
+    if f >= 3:
+        return "at_risk"
+    if r <= 1:
+        return "lost"
+    return "hibernating"
+
+
+def refresh_customer_summary(conn):
+    """Aplica às tabelas de clientes as compras novas desde o último id_compra processado.
+
+    Roda no agendador, na conexão de jobs. Cada lote de CUSTOMER_BATCH_IDS ids
+    é uma transação que avança a marca, então a primeira carga de um histórico
+    grande não vira uma consulta única e, se cair, continua de onde parou.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT to_regclass('resumo_cliente_estado') IS NOT NULL AS existe")
+        if not cursor.fetchone()["existe"]:
+            cursor.execute(CUSTOMER_SUMMARY_DDL)
+        conn.commit()
+        cursor.execute("SELECT ultimo_id_compra FROM resumo_cliente_estado")
+        since = cursor.fetchone()["ultimo_id_compra"]
+        cursor.execute("SELECT MAX(id_compra) AS ultimo FROM compra WHERE id_compra > %s", (since,))
+        until = cursor.fetchone()["ultimo"] or since
+        new_purchases = 0
+        start = max(0, since - CUSTOMER_RESCAN_IDS)
+        while True:
+            end = min(until, start + CUSTOMER_BATCH_IDS)
+            # A linha de estado serializa atualizações concorrentes (outros workers)
+            cursor.execute("SELECT ultimo_id_compra FROM resumo_cliente_estado FOR UPDATE")
+            cursor.execute(CUSTOMER_NEW_PURCHASES_SQL, {"desde": start, "ate": end})
+            batch = cursor.rowcount
+            if batch:
+                # atualizado_em só muda quando o resumo muda (valida os caches)
+                cursor.execute(CUSTOMER_APPLY_SQL)
+                cursor.execute(
+                    "UPDATE resumo_cliente_estado SET ultimo_id_compra = GREATEST(ultimo_id_compra, %s), atualizado_em = now()",
+                    (end,)
+                )
+            elif end > since:
+                cursor.execute("UPDATE resumo_cliente_estado SET ultimo_id_compra = GREATEST(ultimo_id_compra, %s)", (end,))
+            conn.commit()
+            new_purchases += batch
+            if end >= until:
+                break
+            start = end
+        cursor.execute("UPDATE resumo_cliente_estado SET completo = TRUE WHERE NOT completo")
+        conn.commit()
+    finally:
+        cursor.close()
+    return {"lastPurchaseId": until, "newPurchases": new_purchases}
+
+
+def _read_customer_summary_state():
+    # No primário: numa réplica atrasada a tabela recém-criada pode não existir
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT to_regclass('resumo_cliente_estado') IS NOT NULL AS existe")
+        if not cursor.fetchone()["existe"]:
+            return None
+        cursor.execute("SELECT ultimo_id_compra, completo, atualizado_em FROM resumo_cliente_estado")
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def customer_summary_state():
+    """Estado do resumo de clientes; 503 enquanto a primeira carga não terminou."""
+    row = _read_customer_summary_state()
+    if row is None or not row["completo"]:
+        # A carga é do agendador: só antecipa a próxima execução do job
+        scheduler.request_run("customer_summary")
+        raise HTTPException(status_code=503, detail="Resumo de clientes em construção, tente novamente em instantes")
+    return summary_state(row)
+
+
+def summary_state(row):
+    return {"lastPurchaseId": row["ultimo_id_compra"], "updatedAt": row["atualizado_em"].isoformat()}
+
+
+def prepare_summary_tables():
+    """Cria as tabelas de resumo no boot, antes que leituras em réplicas as procurem."""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            for table, ddl in (
+                ("resumo_cliente_estado", CUSTOMER_SUMMARY_DDL),
+                ("baseline_encarte_estado", PROMOTION_BASELINE_DDL),
+            ):
+                cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS existe", (table,))
+                if not cursor.fetchone()["existe"]:
+                    cursor.execute(ddl)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+    except Exception as e:
+        print(f"Erro ao preparar tabelas de resumo: {e}")
+
+
+def summary_is_current(state):
+    # O resultado guardado vale enquanto o resumo não mudou desde o cálculo
+    # (compras atrasadas abaixo da marca também mudam atualizado_em)
+    return lambda value: value["summary"]["updatedAt"] == state["updatedAt"]
+
+
+def fetch_customer_rows(sql, params):
+    """Lê as linhas e o estado do resumo na mesma conexão e no mesmo snapshot.
+
+    Numa réplica atrasada o resultado sai com o estado da réplica, não com o
+    do primário; summary_is_current descarta esse resultado na próxima leitura.
+    """
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SELECT ultimo_id_compra, atualizado_em FROM resumo_cliente_estado")
+        state = summary_state(cursor.fetchone())
+        cursor.execute(sql, params)
+        return state, cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def parse_month(value, field):
+    try:
+        year, month = (int(part) for part in value.split("-"))
+        return date(year, month, 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{field} deve estar no formato YYYY-MM")
+
+
+@router.get("/customers/cohorts")
+def get_customer_cohorts(start_month: str, end_month: str, periods: int = 12):
+    start = parse_month(start_month, "start_month")
+    end = parse_month(end_month, "end_month")
+    if start > end:
+        raise HTTPException(status_code=400, detail="start_month posterior a end_month")
+    if not 1 <= periods <= 60:
+        raise HTTPException(status_code=400, detail="periods deve estar entre 1 e 60")
+
+    state = customer_summary_state()
+    key = f"customer_cohorts:{start.isoformat()}:{end.isoformat()}:{periods}"
+
+    def compute():
+        summary, rows = fetch_customer_rows(CUSTOMER_COHORTS_SQL, {
+            "inicio": start, "fim": shift_months(end, 1), "periodos": periods,
+        })
+        cohorts = {}
+        for row in rows:
+            cohort = cohorts.setdefault(row["coorte"], [None] * periods)
+            cohort[row["periodo"]] = (int(row["clientes"]), float(row["valor"]))
+        result = []
+        for month, activity in sorted(cohorts.items()):
+            size = activity[0][0] if activity[0] else 0
+            result.append({
+                "cohort": month.strftime("%Y-%m"),
+                "customers": size,
+                "active": [a[0] if a else 0 for a in activity],
+                "retention": [round(a[0] / size, 4) if a and size else 0.0 for a in activity],
+                "revenue": [round(a[1], 2) if a else 0.0 for a in activity],
+            })
+        return {"periods": periods, "summary": summary, "cohorts": result}
+
+    return cached_result("customer_cohorts", key, CUSTOMER_CACHE_TTL, compute, valid=summary_is_current(state))
+
+
+@router.get("/customers/rfm")
+def get_customer_rfm(reference_date: Optional[str] = None):
+    reference = parse_iso_date(reference_date, "reference_date") if reference_date else date.today()
+    state = customer_summary_state()
+    key = f"customer_rfm:{reference.isoformat()}"
+
+    def compute():
+        clientes = RFM_UNTIL_REFERENCE_SQL if reference < date.today() else RFM_FROM_SUMMARY_SQL
+        summary, rows = fetch_customer_rows(CUSTOMER_RFM_SQL.format(clientes=clientes), {"referencia": reference})
+        segments = {}
+        for row in rows:
+            segment = segments.setdefault(rfm_segment(row["r"], row["f"]), {
+                "customers": 0, "recencyDays": 0, "purchases": 0, "revenue": 0.0,
+            })
+            segment["customers"] += int(row["clientes"])
+            segment["recencyDays"] += int(row["recencia_total"])
+            segment["purchases"] += int(row["compras"])
+            segment["revenue"] += float(row["valor"])
+        result = []
+        for name, segment in segments.items():
+            customers = segment["customers"]
+            result.append({
+                "segment": name,
+                "customers": customers,
+                "avgRecencyDays": round(segment["recencyDays"] / customers, 1),
+                "avgFrequency": round(segment["purchases"] / customers, 2),
+                "avgMonetary": round(segment["revenue"] / customers, 2),
+                "revenue": round(segment["revenue"], 2),
+            })
+        result.sort(key=lambda s: s["revenue"], reverse=True)
+        return {"referenceDate": reference.isoformat(), "summary": summary, "segments": result}
+
+    return cached_result("customer_rfm", key, CUSTOMER_CACHE_TTL, compute, valid=summary_is_current(state))
+
+
+@router.get("/customers/returning")
+def get_returning_customers(product_id: int, start_date: str, end_date: str, days: int = 30):
+    start = parse_iso_date(start_date, "start_date")
+    end = parse_iso_date(end_date, "end_date")
+    if start > end:
+        raise HTTPException(status_code=400, detail="start_date posterior a end_date")
+    if not 1 <= days <= 365:
+        raise HTTPException(status_code=400, detail="days deve estar entre 1 e 365")
+
+    state = customer_summary_state()
+    key = flight_key("customer_returning", product_id=product_id, start_date=start, end_date=end, days=days)
+
+    def compute():
+        summary, rows = fetch_customer_rows(CUSTOMER_RETURNING_SQL, {
+            "produto": product_id, "inicio": start, "fim": end, "dias": days,
+        })
+        row = rows[0]
+        purchases = int(row["compras"])
+        customers = int(row["clientes"])
+        return {
+            "productId": product_id,
+            "startDate": start.isoformat(),
+            "endDate": end.isoformat(),
+            "days": days,
+            "summary": summary,
+            "purchases": purchases,
+            "purchasesWithReturn": int(row["compras_com_retorno"]),
+            "customers": customers,
+            "returningCustomers": int(row["clientes_com_retorno"]),
+            "returnRate": round(int(row["clientes_com_retorno"]) / customers, 4) if customers else None,
+            "avgDaysToReturn": round(float(row["media_dias"]), 1) if row["media_dias"] is not None else None,
+        }
+
+    return single_flight.do(key, compute)
+
+
+SERIES_BUCKETS = ("day", "week", "month")
+
+
+def parse_iso_date(value, field):
+    try:
+        return date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Data inválida em {field}: {value}")
+
+
+def validate_bucket(bucket, max_points):
+    bucket = bucket.lower()
+    if bucket not in SERIES_BUCKETS:
+        raise HTTPException(status_code=400, detail="bucket deve ser day, week ou month")
+    if max_points and max_points < 3:
+        raise HTTPException(status_code=400, detail="max_points deve ser 0 (sem redução) ou pelo menos 3")
+    return bucket
+
+
+def bucket_start(day, bucket):
+    """Início do bucket que contém o dia (mesma regra do date_trunc do Postgres)."""
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    if bucket == "month":
+        return day.replace(day=1)
+    return day
+
+
+def bucket_range(start, end, bucket):
+    current = bucket_start(start, bucket)
+    while current <= end:
+        yield current
+        if bucket == "month":
+            current = (current + timedelta(days=32)).replace(day=1)
+        else:
+            current += timedelta(days=7 if bucket == "week" else 1)
+
+
+def lttb(points, threshold, value_key):
+    """Reduz a série para `threshold` pontos com Largest-Triangle-Three-Buckets.
+
+    Mantém o primeiro e o último ponto e, em cada faixa intermediária, o ponto
+    que forma o maior triângulo com o escolhido anterior e a média da próxima
+    faixa, preservando picos e vales do desenho.
+    """
+    if not threshold or threshold >= len(points) or threshold < 3:
+        return points
+
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, len(points))
+        avg_x = (avg_start + avg_end - 1) / 2
+        avg_y = sum(p[value_key] for p in points[avg_start:avg_end]) / (avg_end - avg_start)
+
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        a_y = points[a][value_key]
+        max_area = -1
+        chosen = range_start
+        for j in range(range_start, range_end):
+            area = abs((a - avg_x) * (points[j][value_key] - a_y) - (a - j) * (avg_y - a_y))
+            if area > max_area:
+                max_area = area
+                chosen = j
+        sampled.append(points[chosen])
+        a = chosen
+    sampled.append(points[-1])
+    return sampled
+
+
+@router.get("/analysis/sales/timeseries")
+def get_sales_timeseries(
+    product_ids: str,
+    start_date: str,
+    end_date: str,
+    bucket: str = "day",
+    max_points: int = 0
+):
+    bucket = validate_bucket(bucket, max_points)
+    try:
+        ids = list(dict.fromkeys(int(id) for id in product_ids.split(",") if id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="product_ids deve ser uma lista de números separados por vírgula")
+    if not ids:
+        raise HTTPException(status_code=400, detail="Informe ao menos um produto")
+    start = parse_iso_date(start_date, "start_date")
+    end = parse_iso_date(end_date, "end_date")
+
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT id_produto, nome_produto FROM produto WHERE id_produto = ANY(%s)", (ids,))
+        names = {row["id_produto"]: row["nome_produto"] for row in cursor.fetchall()}
+        if not names:
+            raise HTTPException(status_code=404, detail="Produto não encontrado")
+
+        # Uma única consulta agrupada por produto e bucket para todos os produtos
+        cursor.execute(
+            """
+            SELECT
+                i.id_produto,
+                date_trunc(%s, c.data_compra)::date AS bucket,
+                COUNT(*) AS quantity,
+                COALESCE(SUM(i.valor_unitario), 0) AS revenue
+            FROM itens_compra i
+            JOIN compra c ON i.id_compra = c.id_compra
+            WHERE i.id_produto = ANY(%s) AND c.data_compra BETWEEN %s AND %s
+            GROUP BY i.id_produto, bucket
+            """,
+            (bucket, list(names), start, end)
+        )
+        totals = {(row["id_produto"], row["bucket"]): row for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+        conn.close()
+
+    buckets = list(bucket_range(start, end, bucket))
+    series = []
+    for product_id in ids:
+        if product_id not in names:
+            continue
+        points = []
+        for day in buckets:
+            row = totals.get((product_id, day))
+            points.append({
+                "date": day.strftime("%Y-%m-%d"),
+                "quantity": int(row["quantity"]) if row else 0,
+                "revenue": float(row["revenue"]) if row else 0.0,
+            })
+        series.append({
+            "productId": product_id,
+            "productName": names[product_id],
+            "points": lttb(points, max_points, "quantity"),
+        })
 
-@app.get("/stock/history")
-def get_stock_history(query: str, search_type: str, start_date: str, end_date: str):
+    return {
+        "startDate": start_date,
+        "endDate": end_date,
+        "bucket": bucket,
+        "series": series,
+    }
+
+@router.get("/stock/history")
+def get_stock_history(request: Request, query: str, search_type: str, start_date: str, end_date: str, bucket: str = "day", max_points: int = 0):
     print(f"Recebido - Query: {query}, Tipo: {search_type}, Início: {start_date}, Fim: {end_date}")
+    bucket = validate_bucket(bucket, max_points)
+    negotiate_format(request)  # valida o formato antes de consultar o banco
     
-    conn = get_db_connection()
+    conn = get_db_connection("analytics")
     cursor = conn.cursor()
     
     try:
@@ -524,7 +2639,12 @@ def get_stock_history(query: str, search_type: str, start_date: str, end_date: s
                 "value": stock_value
             })
         
-        # 7. Montar resposta
+        # 8. Agrupar por semana/mês e reduzir o número de pontos, se pedido
+        if bucket != "day":
+            history = bucket_stock_history(history, bucket)
+        history = lttb(history, max_points, "quantity")
+
+        # 9. Montar resposta
         response = {
             "productId": product_id,
             "productName": product_name,
@@ -532,11 +2652,13 @@ def get_stock_history(query: str, search_type: str, start_date: str, end_date: s
             "startDate": start_date,
             "endDate": end_date,
             "initialStock": initial_stock,
-            "history": history
+            "bucket": bucket,
         }
 
-        return response
+        return encode_records(request, history, STOCK_HISTORY_COLUMNS, key="history", meta=response)
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Erro ao processar histórico de estoque: {e}")
         raise HTTPException(status_code=500, detail=f"Erro ao processar histórico de estoque: {str(e)}")
@@ -544,11 +2666,218 @@ def get_stock_history(query: str, search_type: str, start_date: str, end_date: s
         cursor.close()
         conn.close()
 
-@app.get("/stock/classification")
-def get_stock_classification(query: str, search_type: str):
+STOCK_HISTORY_COLUMNS = ("date", "quantity", "entries", "outputs", "value")
+
+def bucket_stock_history(history, bucket):
+    """Agrupa o histórico diário: soma entradas/saídas e mantém o saldo do fim do bucket."""
+    grouped = []
+    for day in history:
+        key = bucket_start(date.fromisoformat(day["date"]), bucket).strftime("%Y-%m-%d")
+        if grouped and grouped[-1]["date"] == key:
+            current = grouped[-1]
+            current["entries"] += day["entries"]
+            current["outputs"] += day["outputs"]
+            current["quantity"] = day["quantity"]
+            current["value"] = day["value"]
+        else:
+            grouped.append({**day, "date": key})
+    return grouped
+
+STOCK_CLASSIFICATION_SQL = """
+    WITH dias_vendas AS (
+        -- Conta quantos dias tiveram vendas para calcular a média correta
+        SELECT id_produto, COUNT(DISTINCT c.data_compra) AS dias_com_venda
+        FROM itens_compra ic
+        JOIN compra c ON ic.id_compra = c.id_compra
+        WHERE c.data_compra BETWEEN CURRENT_DATE - INTERVAL '365 days' AND CURRENT_DATE
+        GROUP BY id_produto
+    ),
+    vendas_produto AS (
+        -- Soma o total vendido de cada produto no período analisado
+        SELECT id_produto, SUM(1) AS total_vendido
+        FROM itens_compra ic
+        JOIN compra c ON ic.id_compra = c.id_compra
+        WHERE c.data_compra BETWEEN CURRENT_DATE - INTERVAL '365 days' AND CURRENT_DATE
+        GROUP BY id_produto
+    ),
+    vendas_lote AS (
+        -- Vendas de todos os lotes numa única passada, sem subconsulta por lote
+        SELECT lote, COUNT(*) AS vendidos
+        FROM itens_compra
+        WHERE lote IS NOT NULL {filtro_lotes}
+        GROUP BY lote
+    ),
+    estoque_atual AS (
+        -- Calcula a quantidade disponível no estoque de cada lote
+        SELECT e.id_estoque, e.id_produto, e.lote, e.data_validade,
+               e.quantidade - COALESCE(vl.vendidos, 0) AS quantidade_atual
+        FROM estoque e
+        LEFT JOIN vendas_lote vl ON vl.lote = e.lote
+    ),
+    classificacao_lotes AS (
+        SELECT 
+            ea.id_produto,
+            CASE 
+                WHEN ea.quantidade_atual <= 0 THEN 'SEM ESTOQUE'  -- Lotes já vendidos
+                WHEN ea.data_validade < CURRENT_DATE THEN 'VENCIDO'
+                -- Velocidade em numeric: a divisão inteira arredondaria 1,5/dia para 1/dia
+                WHEN (ea.quantidade_atual / NULLIF(vp.total_vendido::numeric / dv.dias_com_venda, 0)) < 15 
+                     OR ea.data_validade < CURRENT_DATE + INTERVAL '90 days' THEN 'IDADE CRÍTICA'
+                WHEN (ea.quantidade_atual / NULLIF(vp.total_vendido::numeric / dv.dias_com_venda, 0)) > 30 THEN 'STOCK OVER'
+                ELSE 'OK'
+            END AS classificacao,
+            ea.quantidade_atual
+        FROM estoque_atual ea
+        LEFT JOIN vendas_produto vp ON ea.id_produto = vp.id_produto
+        LEFT JOIN dias_vendas dv ON ea.id_produto = dv.id_produto
+        WHERE ea.quantidade_atual > 0 {filtro_produto}
+    )
+    SELECT 
+        id_produto,
+        SUM(CASE WHEN classificacao = 'STOCK OVER' THEN quantidade_atual ELSE 0 END) AS stock_over,
+        SUM(CASE WHEN classificacao = 'IDADE CRÍTICA' THEN quantidade_atual ELSE 0 END) AS critical_age,
+        SUM(CASE WHEN classificacao = 'VENCIDO' THEN quantidade_atual ELSE 0 END) AS expired,
+        SUM(CASE WHEN classificacao = 'OK' THEN quantidade_atual ELSE 0 END) AS ok,
+        SUM(quantidade_atual) AS total
+    FROM classificacao_lotes
+    GROUP BY id_produto
+"""
+
+def classification_response(result):
+    if not result:
+        return {
+            "stockOver": 0,
+            "criticalAge": 0,
+            "expired": 0,
+            "ok": 0,
+            "total": 0
+        }
+
+    return {
+        "stockOver": int(result["stock_over"] or 0),
+        "criticalAge": int(result["critical_age"] or 0),
+        "expired": int(result["expired"] or 0),
+        "ok": int(result["ok"] or 0),
+        "total": int(result["total"] or 0)
+    }
+
+def compute_stock_classification_all():
+    """Classifica o estoque de todos os produtos numa única consulta."""
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
+    try:
+        cursor.execute(STOCK_CLASSIFICATION_SQL.format(filtro_lotes="", filtro_produto=""))
+        return {str(row["id_produto"]): classification_response(row) for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+        conn.close()
+
+# Versão aproximada da classificação: a velocidade de venda (itens por dia com
+# venda) vem de uma amostra de compras do último ano, e só os lotes do produto
+# são lidos por completo.
+SAMPLED_VELOCITY_SQL = """
+    WITH por_compra AS (
+        SELECT c.id_compra, c.data_compra::date AS dia, COUNT(*) AS itens
+        FROM compra c TABLESAMPLE {metodo} (%(percentual)s) REPEATABLE (%(semente)s)
+        JOIN itens_compra ic ON ic.id_compra = c.id_compra AND ic.id_produto = %(produto)s
+        WHERE c.data_compra BETWEEN CURRENT_DATE - INTERVAL '365 days' AND CURRENT_DATE
+        GROUP BY c.id_compra, c.data_compra::date
+    )
+    SELECT
+        COALESCE(SUM(itens), 0) AS itens,
+        COALESCE(SUM(itens * itens), 0) AS quadrados,
+        COUNT(*) AS compras,
+        COUNT(DISTINCT dia) AS dias
+    FROM por_compra
+"""
+
+STOCK_CLASSIFICATION_BY_VELOCITY_SQL = """
+    WITH estoque_atual AS (
+        SELECT e.id_estoque, e.id_produto, e.lote, e.data_validade,
+               e.quantidade - COALESCE((SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote), 0) AS quantidade_atual
+        FROM estoque e
+        WHERE e.id_produto = %(produto)s
+    ),
+    classificacao_lotes AS (
+        SELECT 
+            ea.id_produto,
+            CASE 
+                WHEN ea.quantidade_atual <= 0 THEN 'SEM ESTOQUE'
+                WHEN ea.data_validade < CURRENT_DATE THEN 'VENCIDO'
+                WHEN (ea.quantidade_atual / NULLIF(%(velocidade)s::numeric, 0)) < 15 
+                     OR ea.data_validade < CURRENT_DATE + INTERVAL '90 days' THEN 'IDADE CRÍTICA'
+                WHEN (ea.quantidade_atual / NULLIF(%(velocidade)s::numeric, 0)) > 30 THEN 'STOCK OVER'
+                ELSE 'OK'
+            END AS classificacao,
+            ea.quantidade_atual
+        FROM estoque_atual ea
+        WHERE ea.quantidade_atual > 0
+    )
+    SELECT 
+        id_produto,
+        SUM(CASE WHEN classificacao = 'STOCK OVER' THEN quantidade_atual ELSE 0 END) AS stock_over,
+        SUM(CASE WHEN classificacao = 'IDADE CRÍTICA' THEN quantidade_atual ELSE 0 END) AS critical_age,
+        SUM(CASE WHEN classificacao = 'VENCIDO' THEN quantidade_atual ELSE 0 END) AS expired,
+        SUM(CASE WHEN classificacao = 'OK' THEN quantidade_atual ELSE 0 END) AS ok,
+        SUM(quantidade_atual) AS total
+    FROM classificacao_lotes
+    GROUP BY id_produto
+"""
+
+
+def estimate_sales_days(sampled_days, purchases, days_limit=366):
+    """Corrige os dias com venda vistos na amostra.
+
+    Um dia com m compras do produto aparece na amostra com probabilidade
+    1 - (1 - f)^m; com m estimado como compras / dias, resolve-se
+    dias = dias_amostrados / (1 - (1 - f)^(compras / dias)) por iteração.
+    """
+    f = APPROX_SAMPLE_PERCENT / 100
+    if sampled_days == 0:
+        return 0
+    days = float(sampled_days)
+    for _ in range(50):
+        per_day = max(purchases / days, 1.0)
+        corrected = min(sampled_days / (1 - (1 - f) ** per_day), days_limit, purchases)
+        if abs(corrected - days) < 0.01:
+            break
+        days = max(corrected, float(sampled_days))
+    return days
+
+
+def approximate_stock_classification(cursor, product_id):
+    cursor.execute(SAMPLED_VELOCITY_SQL.format(metodo=APPROX_SAMPLE_METHOD), {
+        "produto": product_id,
+        "percentual": APPROX_SAMPLE_PERCENT,
+        "semente": APPROX_SAMPLE_SEED,
+    })
+    sample = cursor.fetchone()
+    f = APPROX_SAMPLE_PERCENT / 100
+    total_sold, bounds = scale_estimate(int(sample["itens"]), int(sample["quadrados"]))
+    days = estimate_sales_days(int(sample["dias"]), int(sample["compras"]) / f)
+    velocity = total_sold / days if days else None
+    if velocity:
+        velocity_bounds = {"lower": bounds["lower"] / days, "upper": bounds["upper"] / days}
+    else:
+        velocity_bounds = {"lower": 0, "upper": 0}
+
+    cursor.execute(STOCK_CLASSIFICATION_BY_VELOCITY_SQL, {"produto": product_id, "velocidade": velocity})
+    response = classification_response(cursor.fetchone())
+    response["approximation"] = {
+        "method": f"tablesample-{APPROX_SAMPLE_METHOD.lower()}",
+        "samplePercent": APPROX_SAMPLE_PERCENT,
+        "confidence": 0.95,
+        "totalSold": {"estimate": total_sold, **bounds},
+        "salesDays": round(days),
+        "dailyVelocity": {"estimate": round(velocity or 0, 2), **{k: round(v, 2) for k, v in velocity_bounds.items()}},
+    }
+    return response
+
+@router.get("/stock/classification")
+def get_stock_classification(query: str, search_type: str, approx: bool = False):
     print(f"Recebido - Query: {query}, Tipo: {search_type}")
     
-    conn = get_db_connection()
+    conn = get_db_connection("analytics")
     cursor = conn.cursor()
     
     try:
@@ -572,77 +2901,28 @@ def get_stock_classification(query: str, search_type: str):
         if not product_id:
             raise HTTPException(status_code=404, detail="Produto não encontrado")
 
-        # 2. Executar a consulta SQL para classificação de estoque
-        cursor.execute("""
-            WITH dias_vendas AS (
-                -- Conta quantos dias tiveram vendas para calcular a média correta
-                SELECT id_produto, COUNT(DISTINCT c.data_compra) AS dias_com_venda
-                FROM itens_compra ic
-                JOIN compra c ON ic.id_compra = c.id_compra
-                WHERE c.data_compra BETWEEN CURRENT_DATE - INTERVAL '365 days' AND CURRENT_DATE
-                GROUP BY id_produto
-            ),
-            vendas_produto AS (
-                -- Soma o total vendido de cada produto no período analisado
-                SELECT id_produto, SUM(1) AS total_vendido
-                FROM itens_compra ic
-                JOIN compra c ON ic.id_compra = c.id_compra
-                WHERE c.data_compra BETWEEN CURRENT_DATE - INTERVAL '365 days' AND CURRENT_DATE
-                GROUP BY id_produto
-            ),
-            estoque_atual AS (
-                -- Calcula a quantidade disponível no estoque de cada lote
-                SELECT e.id_estoque, e.id_produto, e.lote, e.data_validade,
-                       e.quantidade - COALESCE((SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote), 0) AS quantidade_atual
-                FROM estoque e
+        # 2. Usar a classificação pré-calculada pelo agendador, se estiver em dia
+        precomputed = result_cache.get("stock_classification", job_max_staleness("stock_classification"))
+        if precomputed is not None:
+            return precomputed.get(str(product_id), classification_response(None))
+
+        if approx:
+            return approximate_stock_classification(cursor, product_id)
+
+        # 3. Executar a consulta SQL para classificação de estoque
+        # Para um produto, as vendas por lote se limitam aos lotes dele
+        cursor.execute(
+            STOCK_CLASSIFICATION_SQL.format(
+                filtro_lotes="AND lote IN (SELECT lote FROM estoque WHERE id_produto = %s)",
+                filtro_produto="AND ea.id_produto = %s",
             ),
-            classificacao_lotes AS (
-                SELECT 
-                    ea.id_produto,
-                    CASE 
-                        WHEN ea.quantidade_atual <= 0 THEN 'SEM ESTOQUE'  -- Lotes já vendidos
-                        WHEN ea.data_validade < CURRENT_DATE THEN 'VENCIDO'
-                        WHEN (ea.quantidade_atual / NULLIF(vp.total_vendido / dv.dias_com_venda, 0)) < 15 
-                             OR ea.data_validade < CURRENT_DATE + INTERVAL '90 days' THEN 'IDADE CRÍTICA'
-                        WHEN (ea.quantidade_atual / NULLIF(vp.total_vendido / dv.dias_com_venda, 0)) > 30 THEN 'STOCK OVER'
-                        ELSE 'OK'
-                    END AS classificacao,
-                    ea.quantidade_atual
-                FROM estoque_atual ea
-                LEFT JOIN vendas_produto vp ON ea.id_produto = vp.id_produto
-                LEFT JOIN dias_vendas dv ON ea.id_produto = dv.id_produto
-                WHERE ea.quantidade_atual > 0 AND ea.id_produto = %s
-            )
-            SELECT 
-                SUM(CASE WHEN classificacao = 'STOCK OVER' THEN quantidade_atual ELSE 0 END) AS stock_over,
-                SUM(CASE WHEN classificacao = 'IDADE CRÍTICA' THEN quantidade_atual ELSE 0 END) AS critical_age,
-                SUM(CASE WHEN classificacao = 'VENCIDO' THEN quantidade_atual ELSE 0 END) AS expired,
-                SUM(CASE WHEN classificacao = 'OK' THEN quantidade_atual ELSE 0 END) AS ok,
-                SUM(quantidade_atual) AS total
-            FROM classificacao_lotes
-        """, (product_id,))
+            (product_id, product_id)
+        )
         
         result = cursor.fetchone()
         
-        if not result:
-            return {
-                "stockOver": 0,
-                "criticalAge": 0,
-                "expired": 0,
-                "ok": 0,
-                "total": 0
-            }
-        
-        # 3. Montar resposta
-        response = {
-            "stockOver": int(result["stock_over"] or 0),
-            "criticalAge": int(result["critical_age"] or 0),
-            "expired": int(result["expired"] or 0),
-            "ok": int(result["ok"] or 0),
-            "total": int(result["total"] or 0)
-        }
-
-        return response
+        # 4. Montar resposta
+        return classification_response(result)
         
     except Exception as e:
         print(f"Erro ao processar classificação de estoque: {e}")
@@ -651,20 +2931,31 @@ def get_stock_classification(query: str, search_type: str):
         cursor.close()
         conn.close()
 
-@app.get("/stock/total")
+@router.get("/stock/total")
 def get_stock_total():
-    conn = get_db_connection()
+    return cached_aggregate("stock_total", _compute_stock_total)
+
+def _compute_stock_total():
+    conn = get_db_connection("analytics")
     cursor = conn.cursor()
 
     try:
         cursor.execute("""
-            WITH estoque_atual AS (
+            WITH vendas_lote AS (
+                -- Vendas de todos os lotes numa única passada, sem subconsulta por lote
+                SELECT lote, COUNT(*) AS vendidos
+                FROM itens_compra
+                WHERE lote IS NOT NULL
+                GROUP BY lote
+            ),
+            estoque_atual AS (
                 -- Calcula a quantidade disponível no estoque de cada lote
                 SELECT e.id_estoque, e.id_produto, e.lote, e.data_validade,
-                       e.quantidade - COALESCE((SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote), 0) AS quantidade_atual,
-                       (e.quantidade - COALESCE((SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote), 0)) * p.preco AS valor_atual
+                       e.quantidade - COALESCE(vl.vendidos, 0) AS quantidade_atual,
+                       (e.quantidade - COALESCE(vl.vendidos, 0)) * p.preco AS valor_atual
                 FROM estoque e
                 JOIN produto p ON e.id_produto = p.id_produto
+                LEFT JOIN vendas_lote vl ON vl.lote = e.lote
                 WHERE e.quantidade > 0
             )
             SELECT
@@ -690,20 +2981,34 @@ def get_stock_total():
         cursor.close()
         conn.close()
 
-@app.get("/stock/items")
-def get_stock_items():
-    conn = get_db_connection()
+STOCK_ITEM_COLUMNS = ("productId", "productName", "quantity", "value", "unitPrice")
+
+@router.get("/stock/items")
+def get_stock_items(request: Request):
+    items = cached_aggregate("stock_items", _compute_stock_items)
+    return encode_records(request, items, STOCK_ITEM_COLUMNS)
+
+def _compute_stock_items():
+    conn = get_db_connection("analytics")
     cursor = conn.cursor()
 
     try:
         cursor.execute("""
-            WITH estoque_atual AS (
+            WITH vendas_lote AS (
+                -- Vendas de todos os lotes numa única passada, sem subconsulta por lote
+                SELECT lote, COUNT(*) AS vendidos
+                FROM itens_compra
+                WHERE lote IS NOT NULL
+                GROUP BY lote
+            ),
+            estoque_atual AS (
                 -- Calcula a quantidade disponível no estoque de cada lote
                 SELECT e.id_estoque, e.id_produto, e.lote, e.data_validade,
-                       e.quantidade - COALESCE((SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote), 0) AS quantidade_atual,
-                       (e.quantidade - COALESCE((SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote), 0)) * p.preco AS valor_atual
+                       e.quantidade - COALESCE(vl.vendidos, 0) AS quantidade_atual,
+                       (e.quantidade - COALESCE(vl.vendidos, 0)) * p.preco AS valor_atual
                 FROM estoque e
                 JOIN produto p ON e.id_produto = p.id_produto
+                LEFT JOIN vendas_lote vl ON vl.lote = e.lote
                 WHERE e.quantidade > 0
             )
             SELECT 
@@ -737,26 +3042,176 @@ def get_stock_items():
         cursor.close()
         conn.close()
 
+# Previsão de ruptura e sugestão de reposição para todo o catálogo. A velocidade
+# diária de venda é uma média móvel exponencial (EWMA) calculada para todos os
+# produtos numa única consulta agrupada; o agendador pré-calcula a base e cada
+# requisição só aplica prazo/cobertura e pagina.
+FORECAST_ALPHA = float(os.getenv("FORECAST_ALPHA", "0.1"))
+FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", "90"))
+FORECAST_MAX_PAGE_SIZE = 1000
+
+STOCK_FORECAST_SQL = """
+    WITH vendas_dia AS (
+        -- Vendas por produto e dia nos últimos dias completos
+        SELECT ic.id_produto, c.data_compra::date AS dia, COUNT(*) AS vendas
+        FROM itens_compra ic
+        JOIN compra c ON ic.id_compra = c.id_compra
+        WHERE c.data_compra >= CURRENT_DATE - %(janela)s AND c.data_compra < CURRENT_DATE
+        GROUP BY ic.id_produto, c.data_compra::date
+    ),
+    velocidade AS (
+        -- Peso alfa·(1-alfa)^idade por dia (dias sem venda contam zero),
+        -- normalizado pela soma dos pesos da janela
+        SELECT
+            id_produto,
+            SUM(vendas * %(alfa)s * POWER(1 - %(alfa)s, CURRENT_DATE - 1 - dia))
+                / (1 - POWER(1 - %(alfa)s, %(janela)s)) AS velocidade_ewma,
+            SUM(vendas)::numeric / %(janela)s AS velocidade_media,
+            MAX(dia) AS ultima_venda
+        FROM vendas_dia
+        GROUP BY id_produto
+    ),
+    vendas_lote AS (
+        -- Vendas de todos os lotes numa única passada, sem subconsulta por lote
+        SELECT lote, COUNT(*) AS vendidos
+        FROM itens_compra
+        WHERE lote IS NOT NULL
+        GROUP BY lote
+    ),
+    estoque_atual AS (
+        SELECT e.id_produto, SUM(e.quantidade - COALESCE(vl.vendidos, 0)) AS quantidade
+        FROM estoque e
+        LEFT JOIN vendas_lote vl ON vl.lote = e.lote
+        WHERE e.quantidade - COALESCE(vl.vendidos, 0) > 0
+          AND (e.data_validade IS NULL OR e.data_validade >= CURRENT_DATE)
+        GROUP BY e.id_produto
+    )
+    SELECT
+        p.id_produto,
+        p.nome_produto,
+        COALESCE(ea.quantidade, 0) AS quantidade,
+        COALESCE(v.velocidade_ewma, 0) AS velocidade_ewma,
+        COALESCE(v.velocidade_media, 0) AS velocidade_media,
+        v.ultima_venda
+    FROM produto p
+    LEFT JOIN estoque_atual ea ON ea.id_produto = p.id_produto
+    LEFT JOIN velocidade v ON v.id_produto = p.id_produto
+    WHERE ea.quantidade IS NOT NULL OR v.id_produto IS NOT NULL
+"""
+
+
+def compute_stock_forecast_base():
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
+    try:
+        cursor.execute(STOCK_FORECAST_SQL, {"alfa": FORECAST_ALPHA, "janela": FORECAST_WINDOW_DAYS})
+        return [
+            {
+                "productId": row["id_produto"],
+                "productName": row["nome_produto"],
+                "stock": int(row["quantidade"]),
+                "dailyVelocity": float(row["velocidade_ewma"]),
+                "averageDailyVelocity": float(row["velocidade_media"]),
+                "lastSale": row["ultima_venda"].isoformat() if row["ultima_venda"] else None,
+            }
+            for row in cursor.fetchall()
+        ]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def project_stock(item, today, lead_time_days, coverage_days, safety_days):
+    velocity = item["dailyVelocity"]
+    if velocity > 0:
+        days_of_cover = item["stock"] / velocity
+        stockout_date = (today + timedelta(days=int(days_of_cover))).isoformat()
+        reorder_date = (today + timedelta(days=max(0, int(days_of_cover) - lead_time_days))).isoformat()
+        needed = velocity * (lead_time_days + coverage_days + safety_days)
+        reorder_quantity = max(0, math.ceil(needed - item["stock"]))
+    else:
+        days_of_cover = None
+        stockout_date = None
+        reorder_date = None
+        reorder_quantity = 0
+    return {
+        **item,
+        "dailyVelocity": round(velocity, 3),
+        "averageDailyVelocity": round(item["averageDailyVelocity"], 3),
+        "daysOfCover": round(days_of_cover, 1) if days_of_cover is not None else None,
+        "stockoutDate": stockout_date,
+        "reorderDate": reorder_date,
+        "reorderQuantity": reorder_quantity,
+    }
+
+
+@router.get("/stock/forecast")
+def get_stock_forecast(
+    page: int = 1,
+    page_size: int = 100,
+    lead_time_days: int = 7,
+    coverage_days: int = 30,
+    safety_days: int = 7,
+    only_reorder: bool = False
+):
+    if page < 1 or not 1 <= page_size <= FORECAST_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"page deve ser >= 1 e page_size entre 1 e {FORECAST_MAX_PAGE_SIZE}")
+    if min(lead_time_days, coverage_days, safety_days) < 0:
+        raise HTTPException(status_code=400, detail="Prazos não podem ser negativos")
+
+    base = cached_aggregate("stock_forecast", compute_stock_forecast_base)
+    today = date.today()
+    projections = [
+        project_stock(item, today, lead_time_days, coverage_days, safety_days) for item in base
+    ]
+    if only_reorder:
+        projections = [item for item in projections if item["reorderQuantity"] > 0]
+    # Quem rompe primeiro vem primeiro; produtos sem venda ficam no fim
+    projections.sort(key=lambda item: (item["daysOfCover"] is None, item["daysOfCover"] or 0, item["productName"]))
+
+    start = (page - 1) * page_size
+    return {
+        "page": page,
+        "pageSize": page_size,
+        "total": len(projections),
+        "leadTimeDays": lead_time_days,
+        "coverageDays": coverage_days,
+        "safetyDays": safety_days,
+        "alpha": FORECAST_ALPHA,
+        "windowDays": FORECAST_WINDOW_DAYS,
+        "items": projections[start:start + page_size],
+    }
+
 # Adicionar no seu arquivo main.py existente
 
-@app.get("/api/markup/general")
+@router.get("/api/markup/general")
 def get_general_markup():
+    try:
+        return cached_aggregate("markup_general", _compute_general_markup)
+    except Exception as e:
+        return ({'error': str(e)}), 500
+
+def _compute_general_markup():
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor()
     try:
         # Executar a consulta SQL para obter o mark-up geral
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         cursor.execute("""
-            WITH estoque_atual AS (
+            WITH vendas_lote AS (
+                -- Vendas de todos os lotes numa única passada, sem subconsulta por lote
+                SELECT lote, COUNT(*) AS vendidos
+                FROM itens_compra
+                WHERE lote IS NOT NULL
+                GROUP BY lote
+            ),
+            estoque_atual AS (
                 SELECT 
                     e.id_produto,
                     e.lote,
                     e.valor_unitario,
-                    e.quantidade - COALESCE(
-                        (SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote),
-                        0
-                    ) AS quantidade_disponivel
-                FROM estoque e   
+                    e.quantidade - COALESCE(vl.vendidos, 0) AS quantidade_disponivel
+                FROM estoque e
+                LEFT JOIN vendas_lote vl ON vl.lote = e.lote
             ),
             filtrado AS (
                 SELECT * FROM estoque_atual
@@ -787,26 +3242,31 @@ def get_general_markup():
         """)
         
         result = cursor.fetchone()
-        markup_value = result[0] if result else 0
+        markup_value = result["markup_geral_ponderado"] if result else 0
         
         # Aqui você poderia buscar dados históricos para calcular a variação
         # Por enquanto, vamos usar um valor fixo para a variação
         markup_change = 0.8
         
-        conn.close()
-        
         return ({
             'markupValue': markup_value,
             'markupChange': markup_change
         })
-    except Exception as e:
-        return ({'error': str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
 
-@app.get("/api/markup/product/<int:product_id>")
+@router.get("/api/markup/product/<int:product_id>")
 def get_product_markup(product_id):
+    conn = None
     try:
+        # Mark-up geral para calcular a variação: o mesmo agregado pré-calculado
+        # de /api/markup/general. Lido antes de pegar a conexão da rota, porque
+        # com o cache frio ele abre a sua própria conexão de analytics
+        general_markup = cached_aggregate("markup_general", _compute_general_markup)["markupValue"] or 0
+        
         # Executar a consulta SQL para obter o mark-up do produto
-        conn = get_db_connection()
+        conn = get_db_connection("analytics")
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -846,55 +3306,10 @@ def get_product_markup(product_id):
         """, (product_id,))
         
         result = cursor.fetchone()
-        markup_value = result[1] if result else 0
-        
-        # Obter o mark-up geral para calcular a variação
-        cursor.execute("""
-            WITH estoque_atual AS (
-                SELECT 
-                    e.id_produto,
-                    e.lote,
-                    e.valor_unitario,
-                    e.quantidade - COALESCE(
-                        (SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote),
-                        0
-                    ) AS quantidade_disponivel
-                FROM estoque e   
-            ),
-            filtrado AS (
-                SELECT * FROM estoque_atual
-                WHERE quantidade_disponivel > 0
-            ),
-            markup_por_lote AS (
-                SELECT 
-                    f.id_produto,
-                    f.lote,
-                    f.valor_unitario,
-                    f.quantidade_disponivel,
-                    p.preco,
-                    ((p.preco - f.valor_unitario) / f.valor_unitario) * 100 AS markup_lote,
-                    (((p.preco - f.valor_unitario) / f.valor_unitario) * 100) * f.quantidade_disponivel AS markup_ponderado
-                FROM filtrado f
-                JOIN produto p ON f.id_produto = p.id_produto
-            ),
-            markup_por_produto AS (
-                SELECT 
-                    id_produto,
-                    ROUND(SUM(markup_ponderado) / SUM(quantidade_disponivel), 2) AS markup_medio_ponderado
-                FROM markup_por_lote
-                GROUP BY id_produto
-            )
-            SELECT 
-                ROUND(AVG(markup_medio_ponderado), 2) AS markup_geral_ponderado
-            FROM markup_por_produto;
-        """)
-        
-        general_result = cursor.fetchone()
-        general_markup = general_result[0] if general_result else 0
-        
-        markup_change = round(markup_value - general_markup, 2)
+        markup_value = result["markup_medio_ponderado"] if result else 0
         
-        conn.close()
+        # O agregado pode vir do cache em JSON (float) e o do produto é Decimal
+        markup_change = round(float(markup_value) - float(general_markup), 2)
         
         return ({
             'productId': product_id,
@@ -903,19 +3318,20 @@ def get_product_markup(product_id):
         })
     except Exception as e:
         return ({'error': str(e)}), 500
+    finally:
+        if conn is not None:
+            conn.close()
 
 
 class PerguntaRequest(BaseModel):
     pergunta: str
 
-@app.post("/analytics")
-async def responder_pergunta(req: PerguntaRequest):
-    pergunta = req.pergunta
+def build_analytics_context():
+    """Monta os resumos de vendas e estoque enviados como contexto ao modelo."""
+    conn = get_db_connection("analytics")
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
         cursor.execute("""
             WITH vendas_produto AS (
                 SELECT id_produto, COUNT(*) AS total_vendido
@@ -933,10 +3349,18 @@ async def responder_pergunta(req: PerguntaRequest):
         vendas = cursor.fetchall()
 
         cursor.execute("""
-            WITH estoque_atual AS (
+            WITH vendas_lote AS (
+                -- Vendas de todos os lotes numa única passada, sem subconsulta por lote
+                SELECT lote, COUNT(*) AS vendidos
+                FROM itens_compra
+                WHERE lote IS NOT NULL
+                GROUP BY lote
+            ),
+            estoque_atual AS (
                 SELECT e.id_produto, e.lote,
-                       e.quantidade - COALESCE((SELECT COUNT(*) FROM itens_compra ic WHERE ic.lote = e.lote), 0) AS quantidade_atual
+                       e.quantidade - COALESCE(vl.vendidos, 0) AS quantidade_atual
                 FROM estoque e
+                LEFT JOIN vendas_lote vl ON vl.lote = e.lote
                 WHERE e.quantidade > 0
             )
             SELECT
@@ -949,19 +3373,33 @@ async def responder_pergunta(req: PerguntaRequest):
             GROUP BY p.id_produto, p.nome_produto;
         """)
         estoque = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
 
-        resumo_vendas = "Top 10 produtos mais vendidos no último ano:\n"
-        for v in vendas:
-            total_vendido = v["total_vendido"] or 0
-            resumo_vendas += f"- {v['nome_produto']}: {total_vendido} unidades vendidas, preço médio R$ {v['preco']:.2f}\n"
+    resumo_vendas = "Top 10 produtos mais vendidos no último ano:\n"
+    for v in vendas:
+        total_vendido = v["total_vendido"] or 0
+        resumo_vendas += f"- {v['nome_produto']}: {total_vendido} unidades vendidas, preço médio R$ {v['preco']:.2f}\n"
 
-        resumo_estoque = "Estoque atual resumido:\n"
-        for e in estoque:
-            qtde = e["estoque_atual"] or 0
-            val = e["valor_estoque"] or 0
-            resumo_estoque += f"- {e['nome_produto']}: {qtde} unidades em estoque, valor aproximado R$ {val:.2f}\n"
+    resumo_estoque = "Estoque atual resumido:\n"
+    for e in estoque:
+        qtde = e["estoque_atual"] or 0
+        val = e["valor_estoque"] or 0
+        resumo_estoque += f"- {e['nome_produto']}: {qtde} unidades em estoque, valor aproximado R$ {val:.2f}\n"
 
-        # Você pode juntar mais resumos com outras queries aqui...
+    # Você pode juntar mais resumos com outras queries aqui...
+
+    return resumo_vendas, resumo_estoque
+
+@router.post("/analytics")
+async def responder_pergunta(req: PerguntaRequest):
+    pergunta = req.pergunta
+
+    try:
+        resumo_vendas, resumo_estoque = await run_in_threadpool(
+            cached_aggregate, "analytics_context", build_analytics_context
+        )
 
         prompt = f"""
 Você é um assistente inteligente de análises comerciais.
@@ -974,7 +3412,10 @@ Pergunta do usuário:
 {pergunta}
 """
 
-        resposta = client.chat.completions.create(
+        # O cliente (e o SDK) é carregado no primeiro uso, fora do event loop
+        client = await run_in_threadpool(get_llm_client)
+        resposta = await run_in_threadpool(
+            client.chat.completions.create,
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "Você é um assistente de análise de vendas."},
@@ -985,11 +3426,11 @@ Pergunta do usuário:
 
         return {"resposta": resposta.choices[0].message.content}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro na consulta: {str(e)}")
-    finally:
-        cursor.close()
-        conn.close()
+
 
 
     
@@ -1018,6 +3459,399 @@ Pergunta do usuário:
     #except Exception as e:
      #   raise HTTPException(status_code=500, detail=f"Erro na consulta: {str(e)}")
 
-if __name__ == "__main__":
+
+# Agendador de pré-cálculo dos agregados do dashboard. Cada job roda em
+# intervalos fixos com jitter; um advisory lock do Postgres garante que só um
+# worker execute cada job por vez, e o resultado vai para cache_agregados.
+# Com o lock em mãos o worker ainda confere atualizado_em: se outro worker já
+# atualizou o agregado neste intervalo, só reagenda para depois dele.
+# O lock fica numa conexão da classe "jobs", que só o agendador usa: segurá-la
+# durante o cálculo não tira conexões das requisições. Jobs que gravam no
+# primário (uses_connection=True) recebem essa mesma conexão em compute.
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", "0.1"))
+
+
+class ScheduledJob:
+    def __init__(self, name, compute, interval, uses_connection=False):
+        self.name = name
+        self.compute = compute
+        self.uses_connection = uses_connection
+        self.interval = float(os.getenv(f"SCHEDULER_{name.upper()}_INTERVAL", interval))
+        # Depois de 3 intervalos sem atualização o valor é considerado velho
+        self.max_staleness = float(os.getenv(f"SCHEDULER_{name.upper()}_MAX_STALENESS", self.interval * 3))
+        self.lock_id = zlib.crc32(f"sales-synergy:{name}".encode())
+        self.next_run = 0.0
+        self.last_run = None
+        self.last_duration = None
+        self.last_outcome = None
+        self.last_error = None
+        self.running = False
+
+    def schedule_next(self, now, delay=None):
+        if delay is None:
+            delay = self.interval
+        self.next_run = now + delay + self.interval * random.uniform(0, SCHEDULER_JITTER)
+
+
+class Scheduler:
+    def __init__(self, jobs):
+        self.jobs = {job.name: job for job in jobs}
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(RESULT_CACHE_DDL)
+                conn.commit()
+            finally:
+                cursor.close()
+                conn.close()
+        except Exception as e:
+            print(f"Erro ao preparar tabela de agregados: {e}")
+        now = time.time()
+        for job in self.jobs.values():
+            # Espalha a primeira execução para os workers não competirem no boot
+            job.next_run = now + random.uniform(0, SCHEDULER_JITTER * 10)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.time()
+            for job in self.jobs.values():
+                if self._stop.is_set():
+                    break
+                if job.next_run <= now:
+                    delay = self.run_job(job)
+                    job.schedule_next(time.time(), delay)
+            next_run = min(job.next_run for job in self.jobs.values())
+            self._wake.wait(max(0.5, next_run - time.time()))
+            self._wake.clear()
+
+    def request_run(self, name):
+        """Antecipa a próxima execução de um job (ex.: uma rota precisa do resultado)."""
+        job = self.jobs[name]
+        if not job.running:
+            job.next_run = 0.0
+            self._wake.set()
+
+    def run_job(self, job):
+        try:
+            lock_conn = get_db_connection("jobs")
+        except Exception as e:
+            job.last_outcome = "error"
+            job.last_error = str(e)
+            return
+        cursor = lock_conn.cursor()
+        try:
+            cursor.execute("SELECT pg_try_advisory_lock(%s) AS acquired", (job.lock_id,))
+            if not cursor.fetchone()["acquired"]:
+                # Outro worker está rodando este job
+                job.last_outcome = "skipped"
+                return
+            try:
+                cursor.execute(
+                    "SELECT EXTRACT(EPOCH FROM now() - atualizado_em) AS idade FROM cache_agregados WHERE chave = %s",
+                    (job.name,)
+                )
+                row = cursor.fetchone()
+                if row and float(row["idade"]) < job.interval:
+                    # Outro worker já rodou o job neste intervalo
+                    job.last_outcome = "fresh"
+                    return job.interval - float(row["idade"])
+                job.running = True
+                started = time.time()
+                try:
+                    value = job.compute(lock_conn) if job.uses_connection else job.compute()
+                    job.last_duration = time.time() - started
+                    result_cache.set(cursor, job.name, value, int(job.last_duration * 1000))
+                    lock_conn.commit()
+                    job.last_outcome = "ok"
+                    job.last_error = None
+                except Exception as e:
+                    lock_conn.rollback()
+                    job.last_duration = time.time() - started
+                    job.last_outcome = "error"
+                    job.last_error = str(e)
+                    print(f"Erro ao executar job {job.name}: {e}")
+                finally:
+                    job.running = False
+                    job.last_run = started
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (job.lock_id,))
+        except Exception as e:
+            job.last_outcome = "error"
+            job.last_error = str(e)
+            print(f"Erro no agendador ({job.name}): {e}")
+        finally:
+            cursor.close()
+            lock_conn.close()
+
+    def status(self):
+        updated = {}
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT chave, EXTRACT(EPOCH FROM atualizado_em) AS atualizado_em, duracao_ms
+                    FROM cache_agregados
+                    WHERE chave = ANY(%s)
+                """, (list(self.jobs),))
+                updated = {row["chave"]: row for row in cursor.fetchall()}
+            finally:
+                cursor.close()
+                conn.close()
+        except Exception as e:
+            print(f"Erro ao consultar status dos agregados: {e}")
+
+        now = time.time()
+        jobs = []
+        for job in self.jobs.values():
+            row = updated.get(job.name)
+            staleness = now - float(row["atualizado_em"]) if row else None
+            jobs.append({
+                "name": job.name,
+                "interval": job.interval,
+                "lastRun": job.last_run,
+                "lastDuration": job.last_duration,
+                "lastOutcome": job.last_outcome,
+                "lastError": job.last_error,
+                "running": job.running,
+                "nextRun": job.next_run,
+                "updatedAt": float(row["atualizado_em"]) if row else None,
+                "updateDurationMs": row["duracao_ms"] if row else None,
+                "staleness": staleness,
+                "isStale": staleness is None or staleness > job.max_staleness,
+            })
+        return {"enabled": SCHEDULER_ENABLED, "running": self._thread is not None, "jobs": jobs}
+
+
+scheduler = Scheduler([
+    ScheduledJob("stock_classification", compute_stock_classification_all, 300),
+    ScheduledJob("stock_total", _compute_stock_total, 60),
+    ScheduledJob("stock_items", _compute_stock_items, 60),
+    ScheduledJob("markup_general", _compute_general_markup, 300),
+    ScheduledJob("analytics_context", build_analytics_context, 300),
+    ScheduledJob("stock_forecast", compute_stock_forecast_base, 900),
+    ScheduledJob("promotion_baseline", refresh_promotion_baseline, 86400, uses_connection=True),
+    ScheduledJob("customer_summary", refresh_customer_summary, 300, uses_connection=True),
+    ScheduledJob("result_cache_purge", purge_result_cache, 3600, uses_connection=True),
+])
+
+
+def job_max_staleness(name):
+    job = scheduler.jobs.get(name)
+    return job.max_staleness if job else 0
+
+
+@router.get("/scheduler/status")
+def get_scheduler_status():
+    return scheduler.status()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Recursos do processo: sobem com o worker e são liberados no desligamento
+    if not product_index.loaded:
+        await run_in_threadpool(product_index.try_load)
+    await run_in_threadpool(prepare_summary_tables)
+    if SCHEDULER_ENABLED:
+        scheduler.start()
+    try:
+        yield
+    finally:
+        scheduler.stop()
+        db_router.close_all()
+
+
+def create_app():
+    app = FastAPI(title="Sales Synergy API", lifespan=lifespan)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(CompressionMiddleware)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
+
+
+# Modo multi-processo. O mestre carrega os dados compartilhados (índice de
+# produtos), abre o socket e faz fork dos workers, que herdam tudo por
+# copy-on-write. O número de workers e o tamanho dos pools por worker vêm do
+# número de núcleos e do max_connections do banco.
+DB_RESERVED_CONNECTIONS = int(os.getenv("DB_RESERVED_CONNECTIONS", "10"))
+# Um worker que sai antes de WORKER_MIN_UPTIME segundos conta como falha no
+# boot: o próximo fork espera um backoff exponencial (até WORKER_MAX_BACKOFF)
+# e, depois de WORKER_MAX_FAST_EXITS falhas seguidas, o mestre desiste.
+WORKER_MIN_UPTIME = float(os.getenv("WORKER_MIN_UPTIME", "10"))
+WORKER_MAX_BACKOFF = float(os.getenv("WORKER_MAX_BACKOFF", "30"))
+WORKER_MAX_FAST_EXITS = int(os.getenv("WORKER_MAX_FAST_EXITS", "10"))
+
+
+def plan_workers(workers=0):
+    cores = os.cpu_count() or 1
+    workers = workers or cores
+    pool_sizes = {name: route["pool_size"] for name, route in ROUTE_CLASSES.items()}
+
+    max_connections = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SHOW max_connections")
+            max_connections = int(cursor.fetchone()["max_connections"])
+        finally:
+            cursor.close()
+            conn.close()
+    except Exception as e:
+        print(f"Não foi possível ler max_connections, mantendo os pools configurados: {e}")
+
+    if max_connections:
+        budget = max(len(pool_sizes), max_connections - DB_RESERVED_CONNECTIONS)
+        # Sem conexões para todos: primeiro reduz os pools (mínimo 1 por classe),
+        # depois o número de workers
+        per_worker = budget // workers
+        if per_worker < len(pool_sizes):
+            workers = max(1, budget // len(pool_sizes))
+            per_worker = budget // workers
+        total = sum(pool_sizes.values())
+        if total > per_worker:
+            # Uma conexão garantida por classe e o restante dividido na
+            # proporção dos pools, para que a soma nunca passe de per_worker
+            classes = len(pool_sizes)
+            spare = per_worker - classes
+            pool_sizes = {
+                name: 1 + (size - 1) * spare // (total - classes) for name, size in pool_sizes.items()
+            }
+        if sum(pool_sizes.values()) * workers > budget:
+            workers = max(1, budget // sum(pool_sizes.values()))
+
+    return {
+        "cores": cores,
+        "workers": workers,
+        "maxConnections": max_connections,
+        "poolSizes": pool_sizes,
+    }
+
+
+def serve(host="0.0.0.0", port=8000, workers=0):
+    import gc
+    import signal
+    import socket
+
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+
+    plan = plan_workers(workers)
+    db_router.resize(plan["poolSizes"])
+    print(f"Plano de execução: {plan}")
+
+    product_index.try_load()
+    # Nenhuma conexão pode atravessar o fork: cada worker abre os seus pools
+    db_router.close_all()
+
+    if plan["workers"] == 1:
+        uvicorn.run(app, host=host, port=port)
+        return
+
+    # IPPROTO_TCP explícito: o asyncio só liga TCP_NODELAY nas conexões aceitas
+    # quando o protocolo do socket é TCP, e sem isso cada resposta espera o ACK atrasado
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # Tira os objetos já carregados do coletor de lixo para que as varreduras
+    # nos workers não tirem as páginas compartilhadas do copy-on-write
+    gc.freeze()
+
+    children = {}
+    stopping = False
+    fast_exits = 0
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            server = uvicorn.Server(uvicorn.Config(app, lifespan="on"))
+            server.run(sockets=[sock])
+            os._exit(0)
+        children[pid] = time.time()
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for _ in range(plan["workers"]):
+        spawn()
+    print(f"{plan['workers']} workers ouvindo em {host}:{port}")
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if stopping:
+            continue
+        if started is not None and time.time() - started < WORKER_MIN_UPTIME:
+            fast_exits += 1
+        else:
+            fast_exits = 0
+        if fast_exits >= WORKER_MAX_FAST_EXITS:
+            print(f"Workers saindo logo após o boot {fast_exits} vezes seguidas, encerrando")
+            shutdown(None, None)
+            continue
+        delay = min(WORKER_MAX_BACKOFF, 2 ** (fast_exits - 1)) if fast_exits else 0
+        print(f"Worker {pid} saiu, iniciando outro" + (f" em {delay:.0f}s" if delay else ""))
+        # Espera em passos curtos para um SIGTERM durante o backoff não esperar o backoff inteiro
+        deadline = time.time() + delay
+        while not stopping and time.time() < deadline:
+            time.sleep(min(0.5, deadline - time.time()))
+        if not stopping:
+            spawn()
+    sock.close()
+    if fast_exits >= WORKER_MAX_FAST_EXITS:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    serve(
+        host=os.getenv("API_HOST", "0.0.0.0"),
+        port=int(os.getenv("API_PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "0")),
+    )
@@ -0,0 +1,431 @@
+"""Testes de regressão dos planos de consulta.
+
+Carrega um conjunto sintético e fixo de dados num Postgres local (schema
+plan_tests), chama cada endpoint com get_db_connection instrumentado para
+registrar o SQL executado e roda EXPLAIN (ANALYZE, BUFFERS) em cada consulta
+de leitura. Faz o mesmo com os jobs do agendador cujo resultado os endpoints
+servem em produção, incluindo as gravações deles. Verifica:
+
+- consultas de um único produto não fazem Seq Scan em itens_compra;
+- buffers lidos e linhas por nó de cada consulta ficam dentro dos limites
+  declarados no caso;
+- buffers e tempo de cada endpoint não pioram em relação à linha de base
+  versionada em query_plan_baseline.json.
+
+Uso (a partir da raiz do repositório, com um banco descartável):
+
+    TEST_DATABASE_URL=postgresql://localhost/sales_synergy_test python -m pytest backend/tests
+
+Sem TEST_DATABASE_URL os testes são pulados. A linha de base só é gravada
+com UPDATE_PLAN_BASELINE=1 (depois de uma mudança intencional, ou ao criar
+um caso novo) e o arquivo gerado entra no commit junto com a mudança.
+"""
+import json
+import os
+import re
+import sys
+from datetime import date, timedelta
+from urllib.parse import quote
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("SCHEDULER_ENABLED", "0")
+
+psycopg2 = pytest.importorskip("psycopg2")
+from psycopg2.extras import RealDictCursor  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+UPDATE_BASELINE = os.getenv("UPDATE_PLAN_BASELINE") == "1"
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plan_baseline.json")
+# Folga sobre a linha de base: buffers são quase determinísticos, tempo não
+BUFFER_TOLERANCE = float(os.getenv("PLAN_BUFFER_TOLERANCE", "1.5"))
+TIME_TOLERANCE = float(os.getenv("PLAN_TIME_TOLERANCE", "3.0"))
+TIME_SLACK_MS = float(os.getenv("PLAN_TIME_SLACK_MS", "25"))
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL não definido")
+
+SCHEMA = "plan_tests"
+PRODUCTS = 2000
+PURCHASES = 150000
+ITEMS_PER_PURCHASE = 4
+LOTS_PER_PRODUCT = 5
+DAYS = 730
+PRODUCT_ID = 42
+
+DATA_END = date.today()
+DATA_START = DATA_END - timedelta(days=DAYS)
+
+SCHEMA_SQL = f"""
+    DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;
+    CREATE SCHEMA {SCHEMA};
+    SET search_path TO {SCHEMA};
+
+    CREATE TABLE produto (
+        id_produto INTEGER PRIMARY KEY,
+        nome_produto TEXT NOT NULL,
+        preco NUMERIC(10, 2) NOT NULL
+    );
+    CREATE TABLE compra (
+        id_compra INTEGER PRIMARY KEY,
+        data_compra DATE NOT NULL,
+        cpf TEXT
+    );
+    CREATE TABLE estoque (
+        id_estoque INTEGER PRIMARY KEY,
+        id_produto INTEGER NOT NULL REFERENCES produto,
+        lote TEXT NOT NULL,
+        quantidade INTEGER NOT NULL,
+        valor_unitario NUMERIC(10, 2) NOT NULL,
+        data_validade DATE,
+        tipo_movimentacao TEXT NOT NULL,
+        data_movimentacao TIMESTAMP NOT NULL
+    );
+    CREATE TABLE itens_compra (
+        id INTEGER PRIMARY KEY,
+        id_compra INTEGER NOT NULL REFERENCES compra,
+        id_produto INTEGER NOT NULL REFERENCES produto,
+        valor_unitario NUMERIC(10, 2) NOT NULL,
+        encarte TEXT,
+        lote TEXT
+    );
+"""
+
+# Índices que as consultas da API assumem existir em produção
+INDEXES_SQL = """
+    CREATE INDEX idx_itens_compra_produto ON itens_compra (id_produto);
+    CREATE INDEX idx_itens_compra_compra ON itens_compra (id_compra);
+    CREATE INDEX idx_itens_compra_lote ON itens_compra (lote);
+    CREATE INDEX idx_compra_data ON compra (data_compra);
+    CREATE INDEX idx_estoque_produto ON estoque (id_produto);
+    CREATE INDEX idx_estoque_lote ON estoque (lote);
+"""
+
+# Dados determinísticos (sem random()): mesmas linhas a cada carga, com as
+# datas ancoradas no dia da execução para que os períodos "recentes" da API
+# (previsão, linha de base de encarte, RFM) tenham dados.
+DATA_SQL = """
+    INSERT INTO produto
+    SELECT g, 'Produto ' || g, 2 + (g * 37 %% 500) / 10.0
+    FROM generate_series(1, %(produtos)s) g;
+
+    INSERT INTO compra
+    SELECT g,
+           %(inicio)s::date + (g - 1) * %(dias)s / %(compras)s,
+           CASE WHEN g %% 5 = 0 THEN NULL ELSE lpad((g * 7919 %% 20000)::text, 11, '0') END
+    FROM generate_series(1, %(compras)s) g;
+
+    INSERT INTO estoque
+    SELECT (p - 1) * %(lotes)s + k,
+           p,
+           'L' || p || '-' || k,
+           200 + (p * k %% 300),
+           (2 + (p * 37 %% 500) / 10.0) * 0.7,
+           %(inicio)s::date + k * (%(dias)s / %(lotes)s) + 180,
+           'entrada',
+           %(inicio)s::timestamp + (k - 1) * (%(dias)s / %(lotes)s) * INTERVAL '1 day'
+    FROM generate_series(1, %(produtos)s) p, generate_series(1, %(lotes)s) k;
+
+    INSERT INTO itens_compra
+    SELECT s.g, s.id_compra, s.id_produto, p.preco,
+           CASE WHEN s.id_produto %% 10 = 0 AND (s.id_compra * %(dias)s / %(compras)s / 7) %% 6 = 0 THEN 'S' END,
+           'L' || s.id_produto || '-' || (1 + s.id_compra * %(lotes)s / (%(compras)s + 1))
+    FROM (
+        SELECT g,
+               (g - 1) / %(itens)s + 1 AS id_compra,
+               (g::bigint * 2654435761 %% %(produtos)s)::int + 1 AS id_produto
+        FROM generate_series(1, %(compras)s * %(itens)s) g
+    ) s
+    JOIN produto p ON p.id_produto = s.id_produto;
+"""
+
+# Casos: (nome, caminho, consulta de um único produto?, limites por consulta
+# e agregados que o endpoint lê já prontos do cache). Os limites de buffers e
+# de linhas por nó são o pior valor medido neste conjunto com folga de cerca
+# de 2x: uma regressão de plano (laço por linha, varredura de itens_compra
+# num endpoint de produto) estoura o limite em ordens de grandeza.
+P = PRODUCT_ID
+MONTH_END = DATA_END - timedelta(days=1)
+MONTH_START = MONTH_END - timedelta(days=29)
+YEAR_START = MONTH_END - timedelta(days=364)
+
+
+def case(name, path, single_product=False, buffers=0, rows=0, warm=()):
+    return pytest.param(path, single_product, {"buffers": buffers, "rows": rows}, warm, id=name)
+
+
+CASES = [
+    case("products", "/products", buffers=50, rows=4000),
+    case("product_search_name", f"/products/search/{quote(f'Produto {P}')}", buffers=50, rows=100),
+    case("product_search_id", f"/products/search/{P}?search_type=id", True, buffers=20, rows=10),
+    case("purchases_date_range", f"/purchases/date-range?start_date={MONTH_END}&end_date={DATA_END}", buffers=50, rows=500),
+    case("purchase_items", "/purchase-items/by-purchase-ids?purchase_ids=" + ",".join(str(i) for i in range(1000, 1100)),
+         buffers=600, rows=800),
+    case("analysis_sales", f"/analysis/sales?product_id={P}&start_date={MONTH_START}&end_date={MONTH_END}",
+         True, buffers=2500, rows=3500),
+    # Um ano de compras: o range join lê metade de compra pelo índice de data
+    case("analysis_sales_range", f"/analysis/sales?product_id={P}&comparison_type=ate&start_date={YEAR_START}&end_date={MONTH_END}",
+         True, buffers=5500, rows=150000),
+    case("analysis_sales_second_product",
+         f"/analysis/sales?product_id={P}&comparison_type=ate&is_second_product=true&first_product_id={P + 1}"
+         f"&start_date={YEAR_START}&end_date={MONTH_END}",
+         True, buffers=5500, rows=150000),
+    case("analysis_sales_compare_periods",
+         f"/analysis/sales?product_id={P}&compare_periods=true&start_date={YEAR_START}&end_date={MONTH_START}"
+         f"&second_start_date={MONTH_START}&second_end_date={MONTH_END}",
+         True, buffers=5500, rows=150000),
+    case("analysis_sales_approx", f"/analysis/sales?product_id={P}&start_date={YEAR_START}&end_date={MONTH_END}&approx=true",
+         True, buffers=4000, rows=1000),
+    case("analysis_sales_periods", f"/analysis/sales/periods?product_id={P}&preset=monthly&start_date={MONTH_START}&end_date={MONTH_END}&count=12",
+         True, buffers=5500, rows=150000),
+    case("analysis_sales_timeseries", f"/analysis/sales/timeseries?product_ids={P}&start_date={YEAR_START}&end_date={MONTH_END}&bucket=week",
+         True, buffers=3000, rows=1000),
+    # Relatórios do catálogo: uma passada por itens_compra (600 mil linhas), nunca uma por lote
+    case("analysis_abc", f"/analysis/abc?start_date={YEAR_START}&end_date={MONTH_END}", buffers=21000, rows=1200000),
+    case("analysis_promotions", f"/analysis/promotions?start_date={MONTH_START}&end_date={MONTH_END}", buffers=9600, rows=1200000),
+    case("customers_cohorts", f"/customers/cohorts?start_month={YEAR_START:%Y-%m}&end_month={MONTH_END:%Y-%m}&periods=12",
+         buffers=50, rows=100),
+    # resumo_cliente inteiro, com as versões mortas das atualizações em lote
+    case("customers_rfm", "/customers/rfm", buffers=700, rows=32000),
+    case("customers_returning", f"/customers/returning?product_id={P}&start_date={YEAR_START}&end_date={MONTH_END}&days=30",
+         True, buffers=3300, rows=1000),
+    case("stock_history", f"/stock/history?query={P}&search_type=sku&start_date={MONTH_START}&end_date={MONTH_END}",
+         True, buffers=3000, rows=12500),
+    case("stock_classification", f"/stock/classification?query={P}&search_type=sku", True, buffers=6500, rows=1000),
+    case("stock_classification_approx", f"/stock/classification?query={P}&search_type=sku&approx=true",
+         True, buffers=700, rows=1000),
+    case("stock_total", "/stock/total", buffers=9000, rows=1200000),
+    case("stock_items", "/stock/items", buffers=9000, rows=1200000),
+    case("stock_forecast", "/stock/forecast", buffers=18000, rows=1200000),
+    case("markup_general", "/api/markup/general", buffers=9000, rows=1200000),
+    # O mark-up geral usado na variação vem do agregado do scheduler
+    case("markup_product", f"/api/markup/product/{quote('<int:product_id>')}?product_id={P}",
+         True, buffers=120, rows=1000, warm=("markup_general",)),
+]
+
+
+
+def job_case(name, job, buffers=0, rows=0):
+    return pytest.param(job, {"buffers": buffers, "rows": rows}, id=name)
+
+
+# Consultas dos jobs do agendador, que são o que os endpoints servem em
+# produção (classificação de estoque, contexto do /analytics, linha de base
+# de encarte). Todas percorrem o catálogo inteiro.
+JOB_CASES = [
+    job_case("job_stock_classification", "stock_classification", buffers=31000, rows=1200000),
+    job_case("job_analytics_context", "analytics_context", buffers=12000, rows=1200000),
+    # O INSERT grava ~14 mil linhas e os índices de baseline_encarte
+    job_case("job_promotion_baseline", "promotion_baseline", buffers=123000, rows=1200000),
+]
+
+READ_QUERY = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+WRITE_QUERY = re.compile(r"\b(INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+# Nos jobs as gravações também contam (a linha de base é um INSERT ... SELECT)
+JOB_QUERY = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+
+def connect():
+    return psycopg2.connect(TEST_DATABASE_URL, cursor_factory=RealDictCursor, options=f"-c search_path={SCHEMA}")
+
+
+class RecordingCursor:
+    """Repassa tudo ao cursor real e guarda o SQL já com os parâmetros."""
+
+    def __init__(self, cursor, log):
+        self._cursor = cursor
+        self._log = log
+
+    def execute(self, query, params=None):
+        self._log.append(self._cursor.mogrify(query, params).decode())
+        return self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+
+class RecordingConnection:
+    def __init__(self, conn, log):
+        self._conn = conn
+        self._log = log
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self._conn.cursor(*args, **kwargs), self._log)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", ()):
+        yield from plan_nodes(child)
+
+
+def explain(conn, query, read_only=True):
+    # ANALYZE executa a consulta: leituras rodam numa transação só de leitura,
+    # desfeita a cada consulta; as gravações de um job se acumulam na mesma
+    # transação (o INSERT depende do DELETE anterior) e check_plans a desfaz
+    cursor = conn.cursor()
+    try:
+        if read_only:
+            cursor.execute("SET TRANSACTION READ ONLY")
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query)
+        result = cursor.fetchone()["QUERY PLAN"][0]
+    finally:
+        cursor.close()
+        if read_only:
+            conn.rollback()
+    plan = result["Plan"]
+    nodes = list(plan_nodes(plan))
+    return {
+        "plan": plan,
+        "seq_scans": sorted({n["Relation Name"] for n in nodes if n["Node Type"] == "Seq Scan"}),
+        "buffers": plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0),
+        "max_rows": max(n.get("Actual Rows", 0) * n.get("Actual Loops", 1) for n in nodes),
+        "ms": result["Execution Time"],
+    }
+
+
+@pytest.fixture(scope="module")
+def database():
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SCHEMA_SQL)
+        cursor.execute(DATA_SQL, {
+            "produtos": PRODUCTS, "compras": PURCHASES, "itens": ITEMS_PER_PURCHASE,
+            "lotes": LOTS_PER_PRODUCT, "dias": DAYS, "inicio": DATA_START,
+        })
+        cursor.execute(INDEXES_SQL)
+        conn.commit()
+        conn.autocommit = True
+        # VACUUM também preenche o visibility map (index-only scans como em produção)
+        cursor.execute("VACUUM ANALYZE")
+        conn.autocommit = False
+    finally:
+        cursor.close()
+    yield {"conn": conn}
+    conn.close()
+
+
+@pytest.fixture(scope="module")
+def api(database):
+    from fastapi.testclient import TestClient
+
+    import backend.main as main
+
+    cursor = database["conn"].cursor()
+    cursor.execute(main.RESULT_CACHE_DDL)
+    database["conn"].commit()
+    cursor.close()
+    # Resumos que em produção só o agendador monta, em lotes que atualizam
+    # as mesmas linhas várias vezes; VACUUM como o autovacuum de produção
+    main.refresh_customer_summary(database["conn"])
+    main.refresh_promotion_baseline(database["conn"])
+    database["conn"].autocommit = True
+    cursor = database["conn"].cursor()
+    cursor.execute("VACUUM ANALYZE resumo_cliente, atividade_cliente_mes, compra_cliente")
+    cursor.close()
+    database["conn"].autocommit = False
+
+    log = []
+    warm = {}
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(main, "get_db_connection", lambda route="default": RecordingConnection(connect(), log))
+        # Sem cache: cada chamada precisa chegar ao banco para ter o SQL
+        # registrado, exceto os agregados que o caso declara como já calculados
+        mp.setattr(main.result_cache, "get", lambda name, *args, **kwargs: warm.get(name))
+        yield TestClient(main.app), log, warm, main
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    existing = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            existing = json.load(f)
+    measured = {}
+    yield existing, measured
+    if UPDATE_BASELINE:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(dict(sorted({**existing, **measured}.items())), f, indent=2)
+            f.write("\n")
+
+
+@pytest.mark.parametrize("path,single_product,limits,warm", CASES)
+def test_query_plan(request, database, api, baseline, path, single_product, limits, warm):
+    name = request.node.callspec.id
+    client, log, cache, main = api
+    cache.clear()
+    for aggregate in warm:
+        cache[aggregate] = main.scheduler.jobs[aggregate].compute()
+    log.clear()
+    response = client.get(path)
+    assert response.status_code == 200, response.text
+    assert "error" not in response.json(), response.text
+
+    queries = [q for q in log if READ_QUERY.match(q) and not WRITE_QUERY.search(q)]
+    check_plans(database, baseline, name, queries, single_product, limits)
+
+
+@pytest.mark.parametrize("job_name,limits", JOB_CASES)
+def test_job_query_plan(request, database, api, baseline, job_name, limits):
+    name = request.node.callspec.id
+    _, log, _, main = api
+    job = main.scheduler.jobs[job_name]
+    log.clear()
+    if job.uses_connection:
+        conn = RecordingConnection(connect(), log)
+        try:
+            job.compute(conn)
+            conn.commit()
+        finally:
+            conn.close()
+    else:
+        job.compute()
+
+    queries = [q for q in log if JOB_QUERY.match(q)]
+    check_plans(database, baseline, name, queries, False, limits, read_only=False)
+
+
+def check_plans(database, baseline, name, queries, single_product, limits, read_only=True):
+    assert queries, f"{name}: nenhuma consulta registrada"
+
+    total_buffers = 0
+    total_ms = 0.0
+    try:
+        for query in queries:
+            stats = explain(database["conn"], query, read_only)
+            summary = f"{name}: {query.strip()[:200]}"
+            if single_product:
+                assert "itens_compra" not in stats["seq_scans"], f"Seq Scan em itens_compra em {summary}"
+            assert stats["buffers"] <= limits["buffers"], f"{stats['buffers']} buffers (limite {limits['buffers']}) em {summary}"
+            assert stats["max_rows"] <= limits["rows"], f"nó com {stats['max_rows']} linhas (limite {limits['rows']}) em {summary}"
+            total_buffers += stats["buffers"]
+            total_ms += stats["ms"]
+    finally:
+        database["conn"].rollback()
+
+    existing, measured = baseline
+    measured[name] = {"queries": len(queries), "buffers": total_buffers, "ms": round(total_ms, 2)}
+    if UPDATE_BASELINE:
+        return
+    reference = existing.get(name)
+    assert reference is not None, f"{name}: sem linha de base; grave com UPDATE_PLAN_BASELINE=1"
+    assert total_buffers <= reference["buffers"] * BUFFER_TOLERANCE + 100, (
+        f"{name}: {total_buffers} buffers contra {reference['buffers']} na linha de base"
+    )
+    assert total_ms <= reference["ms"] * TIME_TOLERANCE + TIME_SLACK_MS, (
+        f"{name}: {total_ms:.1f} ms contra {reference['ms']} ms na linha de base"
+    )